@@ -15,9 +15,13 @@ import datetime
 from mpl_toolkits.mplot3d import Axes3D
 from sklearn.cluster import KMeans
 import sys
+import os
 from shapely.geometry import mapping, Polygon
 import Polygon as pl
 import fiona
+from functools import partial
+import maxp
+import plenario
 
 # histogram helper function
 def hist(data, title='Histogram of Values', bins=20, range=None):
@@ -63,9 +67,10 @@ def hist(data, title='Histogram of Values', bins=20, range=None):
 # helper function to determine how to color choropleth
 def sort_regions(self, method='objective'):
     sr = np.zeros([self.k,2])
+    id2pos = dict((area, i) for i, area in enumerate(self.w.id_order))
     for region in range(0,self.k):
         sr[region][0] = region
-        selectionIDs = [self.w.id_order.index(i) for i in self.regions[region]]
+        selectionIDs = [id2pos[i] for i in self.regions[region]]
         m = self.z[selectionIDs, :]
         if method == 'objective':
             var = m.var(axis=0)
@@ -79,7 +84,7 @@ def sort_regions(self, method='objective'):
         self.sorted_regions[int(srdf[i:i+1][0])] = i
 
 # extend Maxp with new method
-ps.Maxp.sort_regions = sort_regions
+maxp.Maxp.sort_regions = sort_regions
 
 
 
@@ -114,9 +119,10 @@ class Blobs_Data:
                     ['crimes_2001_to_present', 'business_licenses']
                   if empty, will automatically include all available datasets
 
-    temporal_agg: {'day', 'week', 'month', 'quarter', 'year', 'decade'}
+    temporal_agg: {'month', 'quarter', 'year', 'decade'}
                   the desired level of temporal aggregation for the Plenario
-                    data (currently does not make a difference in the end)
+                    data; counts are always downloaded by month, and summed 
+                    into these periods in period_counts
 
     time_start  : 'yyyy-mm-dd'
                   the start date for Plenario data; default is Jan 1, 2000
@@ -124,6 +130,40 @@ class Blobs_Data:
     time_end    : 'yyyy-mm-dd'
                   the end date for Plenario data; default is today
 
+    api_url     : string
+                  the Plenario timeseries endpoint; point it at a local
+                    server to test without Plenario
+
+    n_threads   : int
+                  number of downloads running at once (8 by default)
+
+    journal     : string
+                  file recording each download as it completes, so that an
+                    interrupted run picks up where it stopped when started
+                    again; removed once the download is complete ('plenario 
+                    progress by month.jsonl' by default; None to keep no 
+                    record)
+
+    cache       : string or plenario.ResponseCache
+                  folder where downloaded responses are kept, so that later
+                    runs with the same datasets, dates and aggregation read
+                    them from disk ('plenario cache' by default, keeping
+                    responses for 30 days and up to 1 GB; None for no cache)
+
+    bulk        : boolean
+                  if True, page through the records of every dataset for the
+                    whole county in a few large requests and count them by
+                    unit locally, instead of asking for each unit separately
+
+    detail_url  : string
+                  the Plenario detail endpoint used in bulk mode
+
+    cube        : string
+                  .npz file keeping the monthly counts by unit and dataset 
+                    ('plenario counts.npz' by default; None to keep no file). 
+                    if it holds the units, datasets and dates asked for, the
+                    counts are read from it instead of downloaded
+
     Attributes
     ----------
     data        : pandas DataFrame
@@ -131,6 +171,18 @@ class Blobs_Data:
                     population, and a count of observations for each dataset 
                     by unit of analysis
 
+    cube        : plenario.CountCube
+                  counts by unit, dataset and month, which give the totals 
+                    for any other window within time_start and time_end
+
+    periods     : array
+                  labels of the periods of length temporal_agg between 
+                    time_start and time_end
+
+    period_counts: array
+                  count of observations for each unit (in the order they
+                    first appear in census_data), dataset and period
+
     Sample usage
     ------------
 
@@ -141,89 +193,88 @@ class Blobs_Data:
     """
 
     def __init__(self, census_data, level, shp, shp_id, datasets=[], temporal_agg='month', 
-        time_start='2000-01-01', time_end=None):
+        time_start='2000-01-01', time_end=None, api_url=plenario.BASE_URL, 
+        n_threads=plenario.N_THREADS, journal='plenario progress by month.jsonl', 
+        cache='plenario cache', bulk=False, detail_url=plenario.DETAIL_URL, 
+        cube='plenario counts.npz'):
         self.shp_link = shp
+        if temporal_agg not in plenario.PERIODS:
+            raise ValueError("temporal_agg must be in {'month', 'quarter', "
+                "'year', 'decade'}")
         if not time_end:
             time_end = time.strftime('%Y') + '-' + time.strftime('%m') + \
             '-' + time.strftime('%d')
-        self.prefix_url = 'http://plenar.io/v1/api/timeseries/?obs_date__ge='+\
-            time_start + '&obs_date__le=' + time_end + '&agg=' + \
-            temporal_agg + '&data_type=csv'
+        self.params = [('obs_date__ge', time_start), ('obs_date__le', time_end),
+            ('agg', 'month'), ('data_type', 'csv')]
         if len(datasets) > 0:
-            self.prefix_url += '&dataset_name__in=' + ','.join(datasets)
+            self.params.append(('dataset_name__in', ','.join(datasets)))
+        self.prefix_url = api_url + '?' + '&'.join(k + '=' + v for k, v in self.params)
 
         # data preparation
         census = pd.read_csv(census_data, dtype=object)
-        final = []
-        done = set([])
+        widths = {'tract': 11, 'block group': 12, 'block': None}
+        if level not in widths:
+            raise ValueError("level must be in {'tract', 'block group', 'block'}")
 
-        sys.stdout.write('\n')
+        sys.stdout.write('\npreparing ' + str(census.shape[0]) + ' lines')
         sys.stdout.flush()
 
-        for i in range(0, len(census)):
-            # assemble the various IDs using the FIPS code
-            block = census.id[i][9:]
-            if level == 'tract':
-                check = block[0:11]
-            elif level == 'block group':
-                check = block[0:12]
-            elif level == 'block':
-                check = block[0:]
-            else:
-                print "error: 'level' must be in {'tract', 'block group', 'block'}"
-                return False
-            if check not in done:
-                done.add(check)
-                row = [check, block[0:2], block[2:5], block[5:11]]
-                try:
-                    row.append(int(census['pop'][i]))
-                except: #some pop data is screwed up
-                    row.append(0)
-                final.append(row)
-                sys.stdout.write('\rpreparing line ' + str(i+1) + ' of ' + str(census.shape[0]) + 
-                    ' (' + str(round(i * 100./census.shape[0], 2)) + '% done)')
-                sys.stdout.flush()
-            else:
-                # just add the population
-                try:
-                    final[-1][4] += int(census['pop'][i])
-                except:
-                    pass
+        # assemble the various IDs using the FIPS code
+        block = census['id'].str[9:]
+        check = block.str[:widths[level]]
+        # some pop data is screwed up; anything int() rejects counts as 0
+        pop = census['pop'].astype(str)
+        pop = pop.where(pop.str.match(r'^\s*[-+]?\d+\s*$'), '0')
+        pop = pop.str.strip().astype(np.int64)
+        # a unit starts at the first line with its ID, and every later line 
+        # adds its population to the unit started last
+        first = ~check.duplicated()
+        unit = first.cumsum()
+        final = pd.DataFrame({'ID': check[first].values, 
+            'stateID': block[first].str[0:2].values, 
+            'countyID': block[first].str[2:5].values, 
+            'tractID': block[first].str[5:11].values, 
+            'pop': pop.groupby(unit).sum().astype(str).values}, 
+            columns=['ID', 'stateID', 'countyID', 'tractID', 'pop'])
 
         sys.stdout.write('\rdata preparation complete' + (' ' * 30) + '\n')
         sys.stdout.flush()
 
-        final = pd.DataFrame(np.array(final))
-
         for d in datasets:
             final[d] = 0
 
         final.columns = ['ID', 'stateID', 'countyID', 'tractID', 'pop'] + datasets
 
-        times = []
-        sys.stdout.write('\rdownloading data...')
-        sys.stdout.flush()
-        for t in range(0, len(final)):
-            start = time.time()
-            if level == 'tract' or level == 'block group':
-                url = self.prefix_url + '&census_block__ilike=' + str(final.ix[t, 0]) + '%'
-            elif level == 'block':
-                url = self.prefix_url + '&census_block=' + str(final.ix[t, 0])
-            cr = pd.read_csv(url)
-            for name in datasets:
-                try:
-                    final.ix[t, name] = cr[name].sum()
-                except:
-                    final.ix[t, name] = 0
-            end = time.time()
-            times.append(end - start)
-            sys.stdout.write('\rdownloading data for ' + level + ' ' + str(t+1) + ' of ' + 
-                str(final.shape[0]) + ' (' + 
-                str(round(t * 100./final.shape[0], 2)) + '% done, ' + 
-                str(int(np.mean(times)*(len(final)-t-1)/60.))+' minutes remaining)')
+        units = final['ID'].values
+        self.cube = None
+        if cube and os.path.exists(cube):
+            self.cube = plenario.load_cube(cube)
+            if not self.cube.covers(units, datasets, time_start, time_end):
+                self.cube = None
+        if self.cube is None:
+            sys.stdout.write('\rdownloading data...')
             sys.stdout.flush()
-        sys.stdout.write('\rdata download complete' + (' ' * 30) + '\n')
+            if isinstance(cache, basestring):
+                cache = plenario.ResponseCache(cache)
+            if bulk:
+                downloader = plenario.Downloader(detail_url, n_threads=n_threads, cache=cache)
+                self.cube = self._bulk_counts(downloader, final, level, datasets, 
+                    time_start, time_end, journal)
+            else:
+                downloader = plenario.Downloader(api_url, n_threads=n_threads, cache=cache)
+                self.cube = self._unit_counts(downloader, final, level, datasets, 
+                    time_start, time_end, journal)
+            if cube:
+                self.cube.save(cube)
+            sys.stdout.write('\rdata download complete' + (' ' * 30) + '\n')
+        else:
+            sys.stdout.write('\rcounts read from ' + cube + (' ' * 30) + '\n')
         sys.stdout.flush()
+        counts = self.cube.totals(time_start, time_end, units, datasets)
+        self.periods, self.period_counts = self.cube.aggregate(temporal_agg, 
+            time_start, time_end, units, datasets)
+        for j, name in enumerate(datasets):
+            final[name] = counts[:, j]
 
         final.to_csv('plenario data by block.csv', index=False)
 
@@ -231,9 +282,9 @@ class Blobs_Data:
         self.w = ps.open(self.shp_link[:-3] + 'gal').read()
         self.id = shp_id
         self.level = level
-        cols = np.array([dbf.by_col(col) for col in dbf.header]).T
+        cols = np.array([self.dbf.by_col(col) for col in self.dbf.header]).T
         df = pd.DataFrame(cols)
-        df.columns = dbf.header
+        df.columns = self.dbf.header
         df.columns = df.columns.map(lambda x: x.lower())
         df['order'] = df.index # mark the order of the shapes
         for c in final.columns[4:]:
@@ -248,15 +299,87 @@ class Blobs_Data:
             ordered = pd.DataFrame(df.loc[:,[shp_id, 'order']])
             self.data = pd.merge(final, ordered, how='right', left_on='ID', 
                 right_on=shp_id, sort=False).fillna(0).sort(['order'])
-        self.data = self.data.drop(['order'])
+        self.data = self.data.drop(['order'], axis=1)
         print('\rdata ready to use\n\n')
-        return True
+
+    def _unit_counts(self, downloader, final, level, datasets, time_start, 
+        time_end, journal):
+        # one timeseries query per unit
+        queries = []
+        for t, unit in enumerate(final['ID']):
+            if level == 'tract' or level == 'block group':
+                unit_param = ('census_block__ilike', str(unit) + '%')
+            elif level == 'block':
+                unit_param = ('census_block', str(unit))
+            queries.append((t, self.params + [unit_param]))
+        results = [None] * len(final)
+        start = time.time()
+        downloads = downloader.fetch(queries, 
+            partial(plenario.monthly_counts, datasets=datasets), journal)
+        for n_done, (t, result) in enumerate(downloads):
+            results[t] = result
+            elapsed = time.time() - start
+            sys.stdout.write('\rdownloading data for ' + level + ' ' + str(n_done+1) + ' of ' + 
+                str(final.shape[0]) + ' (' + 
+                str(round(n_done * 100./final.shape[0], 2)) + '% done, ' + 
+                str(int(elapsed/(n_done+1)*(len(final)-n_done-1)/60.))+' minutes remaining)')
+            sys.stdout.flush()
+        months = np.array(sorted(set(month for result in results 
+            for month in result['months'])), dtype=str)
+        counts = np.zeros((len(final), len(datasets), len(months)), dtype=np.int32)
+        for t, result in enumerate(results):
+            if result['months']:
+                counts[t][:, np.searchsorted(months, result['months'])] = \
+                    np.array(result['counts']).T
+        return plenario.CountCube(final['ID'].values, datasets, months, counts, 
+            time_start, time_end)
+
+    def _bulk_counts(self, downloader, final, level, datasets, time_start, 
+        time_end, journal):
+        # page through each dataset's records by county, then count by unit
+        width = {'tract': 11, 'block group': 12, 'block': 15}[level]
+        counties = sorted(set(final['stateID'] + final['countyID']))
+        pages = []
+        for j, name in enumerate(datasets):
+            n_records = 0
+            for county in counties:
+                params = [('dataset_name', name), ('obs_date__ge', time_start), 
+                    ('obs_date__le', time_end), ('census_block__ilike', county + '%'), 
+                    ('data_type', 'csv')]
+                for n, page in downloader.fetch_pages(params, plenario.block_counts, 
+                    journal=journal):
+                    if page['counts']:
+                        page = pd.DataFrame(page)
+                        page['dataset'] = j
+                        pages.append(page)
+                    n_records += n
+                    sys.stdout.write('\rdownloading ' + name + ' (' + str(n_records) + 
+                        ' records)' + (' ' * 10))
+                    sys.stdout.flush()
+        if not pages:
+            return plenario.CountCube(final['ID'].values, datasets, [], 
+                np.zeros((len(final), len(datasets), 0)), time_start, time_end)
+        records = pd.concat(pages, ignore_index=True)
+        records['unit'] = records['blocks'].str[:width]
+        by_unit = records.groupby(['unit', 'dataset', 'months'])['counts'].sum()
+        unit = pd.Index(final['ID'].values).get_indexer(
+            by_unit.index.get_level_values('unit'))
+        dataset = np.asarray(by_unit.index.get_level_values('dataset'), dtype=int)
+        by_month = np.asarray(by_unit.index.get_level_values('months'), dtype=str)
+        months = np.unique(by_month)
+        month = np.searchsorted(months, by_month)
+        counts = np.zeros((len(final), len(datasets), len(months)), dtype=np.int32)
+        # records from blocks outside the census units are left out
+        keep = unit >= 0
+        counts[unit[keep], dataset[keep], month[keep]] = by_unit.values[keep]
+        return plenario.CountCube(final['ID'].values, datasets, months, counts, 
+            time_start, time_end)
 
 
 # main blobs class
 class Blobs:
     """Create a max-p regions solution for a given shapefile and associated 
-    dataset. Builds on pysal.Maxp with improvements to the user interface, 
+    dataset. Builds on maxp.Maxp with improvements to the user interface, 
     flexibility, and mapping. 
 
     Original solution from "The Max-p-Regions Problem," Duque, Anselin, and Rey, 
@@ -273,7 +396,8 @@ class Blobs:
 
     floor       : minimum size of each blob, as measured by floor_var
                   if floor_var is 'areas', this is the minimum number of areas
-                    in each blob
+                    in each blob. a ValueError is raised straight away if some
+                    group of connected areas cannot reach it
 
     vars_to_use : variables on which to create blobs
                   default is all variables in the dataset, except for ID ones
@@ -307,6 +431,39 @@ class Blobs:
                   will print out comprehensive information about the progress
                     of the solution
 
+    n_jobs      : int
+                  number of worker processes that solve iterations
+                    concurrently; -1 uses all CPU cores (1 by default). with
+                    a single iteration the workers build its initial 
+                    solutions instead
+
+    seed        : int
+                  master seed for the random number generators. each 
+                    iteration gets its own seed drawn from it, so the result
+                    is the same whatever the value of n_jobs
+
+    time_budget : float
+                  seconds that building blobs may take. the budget is shared
+                    among the iterations, and when it runs out the best 
+                    solution so far is used (None by default: no limit)
+
+    local_search: {None, 'descent', 'first', 'sample', 'tabu', 'annealing'}
+                  local search used to improve each solution; see maxp.Maxp
+                    (None by default: steepest descent swapping)
+
+    prune       : boolean
+                  prefer solutions with more blobs and give up on initial
+                    solutions that cannot reach the most blobs found so far;
+                    see maxp.Maxp (False by default)
+
+    warm_start  : Blobs, dict or array
+                  an earlier solution to start from, e.g. the Blobs built for
+                    the previous hour of a temporal slicing. it may also be
+                    the area2region or labels of a maxp.Maxp on the same 
+                    weights. blobs that no longer meet the floor or are no
+                    longer contiguous are repaired, then swapping starts
+                    straight away (None by default: build from scratch)
+
 
     Attributes
     ----------
@@ -314,7 +471,7 @@ class Blobs:
     regions     : numpy array
                   The assigned blob for each area, in the original order
 
-    r           : PySAL MaxP instance
+    r           : maxp.Maxp instance
                   The best solution found.
     
     contours    : List of Shapely.Polygon instances
@@ -335,7 +492,13 @@ class Blobs:
     build_blobs(): Will rebuild blobs. Currently there is no way to reassign
                      parameters here - to do that, create another Blobs object.
                      However, this method may return a different solution 
-                     because of randomness. 
+                     because of randomness.
+
+    update(rows): Will re-solve blobs around the areas in rows, a DataFrame
+                     of new data for some areas, keeping the other blobs
+                     as they are. Example:
+
+                     b.update(new_counts)
 
     generate_contours(): Generate contours for blobs after building blobs.
 
@@ -353,7 +516,8 @@ class Blobs:
     """
     def __init__(self, bd, floor_var, floor, vars_to_use=[], iterations=10, 
     method='equal votes', weights=[], initial=10, plot=True, savedata=False, 
-    plot_values=False, verbose=False):
+    plot_values=False, verbose=False, n_jobs=1, seed=None, time_budget=None, 
+    local_search=None, prune=False, warm_start=None):
         self.d = bd.data
         self.w = bd.w
         self.shp_link = bd.shp_link
@@ -374,6 +538,14 @@ class Blobs:
         self.savedata = savedata
         self.plot_values = plot_values
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.time_budget = time_budget
+        self.local_search = local_search
+        self.prune = prune
+        if isinstance(warm_start, Blobs):
+            warm_start = warm_start.r.labels
+        self.warm_start = warm_start
         self.r = None
         self.regions = None
         self.blobs_data = None
@@ -394,55 +566,117 @@ class Blobs:
         iteration = []
         best_score = -1
         best_solution = None
-        if self.floor_var == 'areas':
-            floor_var_array = np.ones((self.d.shape[0], 1))
-        else:
-            floor_var_array = self.d[self.floor_var]
-        blob_vars = np.array(self.d.loc[:, self.vars_to_use], np.float64)
-        
-        if len(self.vars_to_use) == 1:
-            # add shape to the array
-            blob_vars.shape = (blob_vars.shape[0], 1)
+        z, floor_var_array = self._arrays()
         print('\n### CREATING BLOBS FROM ' + str(len(self.vars_to_use)) + 
             ' VARIABLES ###\n    PARAMETERS:\n     # Minimum ' + self.floor_var + ' in each blob: ' + 
             str(int(self.floor)) + '\n     # Iterations: ' + str(self.iterations) +
             '\n     # Method: ' + self.method + '\n     # Plot blobs: ' + str(self.plot) + 
             '\n     # Save blobs data: ' + str(self.savedata) + '\n')
-
-        for i in range(0,self.iterations):
-            start = time.time()
-            r=ps.Maxp(self.w, self._format_blobs(blob_vars),
-                floor=self.floor, floor_variable=floor_var_array, 
-                initial=self.initial, verbose=self.verbose)
+        if self.time_budget is not None:
+            print('     # Time budget: ' + str(self.time_budget) + ' seconds\n')
+
+        bound = maxp.Maxp._unsolved(self.w, z, self.floor, floor_var_array)
+        if bound._short_components:
+            # fail before any iteration runs, e.g. when sweeping floors
+            raise ValueError(str(bound._short_components) + ' group(s) of ' +
+                'connected areas have less than ' + str(int(self.floor)) + ' ' +
+                self.floor_var + ' in total, so no blobs can be built')
+        print('     # At most ' + str(bound.p_max) + ' blobs possible\n')
+        solved =self._solve_iterations(z, floor_var_array)
+        for i, (r, current_score, k, elapsed) in enumerate(solved):
             end = time.time()
-            times.append(end - start)
+            times.append(elapsed)
+            if r is None:
+                print('\n# ITERATION '+str(i+1)+'                 \n  No feasible '+
+                    'solution found\n  Time taken: '+str(round(elapsed,1))+' seconds\n')
+                continue
             current_time.append(end)
-            current_score = r.objective_function()
             solutions.append(current_score)
-            num_blobs.append(r.k)
+            num_blobs.append(k)
             if (best_score == -1 or current_score < best_score):
                 best_score = current_score
                 best_solution = r
             top_scores.append(best_score)
             iteration.append(i)
             msg = '\n# ITERATION '+str(i+1)+'                 \n  Score: ' + \
-                str(round(current_score,2)) + '\n  Created '+str(r.k)+' blobs (' + \
-                str(int(self.d.shape[0]/r.k)) + ' tracts per blob)\n  Best solution so far: ' + \
+                str(round(current_score,2)) + '\n  Created '+str(k)+' blobs (' + \
+                str(int(self.d.shape[0]/k)) + ' tracts per blob)\n  Best solution so far: ' + \
                 str(round(best_score,2))
-            msg += '\n  Time taken: '+str(round(end-start,1))+' seconds ('+ \
-                str(int(np.mean(times)*(self.iterations-i-1)))+' seconds remaining)\n'
+            msg += '\n  Time taken: '+str(round(elapsed,1))+' seconds ('+ \
+                str(int(np.mean(times)*(self.iterations-i-1)/self._workers()))+ \
+                ' seconds remaining)\n'
             print msg
-        
+
+        if best_solution is None:
+            raise ValueError('no feasible solution found in any of the ' + 
+                str(len(times)) + ' iterations')
+        if not isinstance(best_solution, maxp.Maxp):
+            # labels returned by a worker process
+            best_solution = maxp.Maxp.from_labels(self.w, z, self.floor,
+                floor_var_array, best_solution)
         r = best_solution
         print('\r# BEST SOLUTION:                      \n  Score: '+
             str(round(r.objective_function(),2)) + 
             '\n  '+str(r.k)+' blobs ('+str(int(self.d.shape[0]/r.k))+
             ' tracts per blob)')
-        self.r = r
-        # prep for plotting
+        self._use_solution(r)
+
+    def update(self, rows):
+        """ Method to re-solve blobs after new data for some areas, e.g. 
+        fresh Plenario counts. Blobs away from the changed areas are kept as
+        they are; those that now fall below the floor, or that a changed 
+        area would rather leave, are rebuilt together with their neighbors.
+
+        Parameters
+        ----------
+
+        rows        : pandas DataFrame
+                      the new data: a column with the ID of each changed area
+                        (named like the ID of the data) and the columns that
+                        changed
+
+        """
+        position = dict((area, j) for j, area in enumerate(self.d[self.id_var]))
+        changed = [position[area] for area in rows[self.id_var]]
+        for col in rows.columns:
+            if col != self.id_var:
+                self.d.iloc[changed, self.d.columns.get_loc(col)] = \
+                    np.array(rows[col])
+        z, floor_var_array = self._arrays()
+        ids = self._area_ids()
+        start = time.time()
+        freed = self.r.update(z, floor_var_array, [ids[j] for j in changed])
+        print('\n# UPDATED ' + str(len(changed)) + ' AREAS:\n  Rebuilt ' + 
+            str(freed) + ' of ' + str(self.r.k) + ' blobs\n  Score: ' + 
+            str(round(self.r.objective_function(),2)) + '\n  Time taken: ' + 
+            str(round(time.time() - start,1)) + ' seconds\n')
+        self._use_solution(self.r)
+        self.generate_contours()
+
+    def _arrays(self):
+        # attributes and floor variable as passed to maxp
+        if self.floor_var == 'areas':
+            floor_var_array = np.ones((self.d.shape[0], 1))
+        else:
+            floor_var_array = self.d[self.floor_var]
+        blob_vars = np.array(self.d.loc[:, self.vars_to_use], np.float64)
+        
+        if len(self.vars_to_use) == 1:
+            # add shape to the array
+            blob_vars.shape = (blob_vars.shape[0], 1)
+        return self._format_blobs(blob_vars), floor_var_array
+
+    def _area_ids(self):
+        # the id in w of the area in each row of the data
         ids=np.array(self.d[self.id_var]).astype(str)
         if self.level == 'block':
             ids = map(str,np.arange(self.d.shape[0]))
+        return ids
+
+    def _use_solution(self, r):
+        self.r = r
+        # prep for plotting
+        ids = self._area_ids()
         if self.plot_values:
             self.r.sort_regions(method='mean')  # sort regions by intensity of the variable
         regions=np.empty(self.d.shape[0])
@@ -454,6 +688,65 @@ class Blobs:
             self.plot_blobs()
         self.build_data_structure(self.savedata)
 
+    def _workers(self):
+        return maxp._workers(self.n_jobs, self.iterations)
+
+    def _iteration_seeds(self):
+        # one independent seed per iteration, all drawn from the master seed
+        if self.seed is None:
+            seeds = np.random.randint(0, maxp.MAX_SEED, self.iterations)
+        else:
+            seeds = np.random.RandomState(self.seed).randint(0, maxp.MAX_SEED, 
+                self.iterations)
+        return seeds.tolist()
+
+    def _solve_iterations(self, z, floor_var_array):
+        # yield (solution, score, number of blobs, seconds) per iteration, in
+        # iteration order. worker processes return label arrays instead of
+        # Maxp objects, and iterations without a feasible solution give
+        # (None, None, 0, seconds). with a time budget, iterations stop once
+        # it is spent (after at least one has finished)
+        seeds = self._iteration_seeds()
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
+        if self._workers() == 1:
+            for i, seed in enumerate(seeds):
+                budget = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0 and i > 0:
+                        return
+                    # split what is left evenly over the remaining iterations
+                    budget = max(remaining, 0) / (len(seeds) - i)
+                start = time.time()
+                r = maxp.Maxp(self.w, z, floor=self.floor, 
+                    floor_variable=floor_var_array, initial=self.initial, 
+                    verbose=self.verbose, seed=seed, n_jobs=self.n_jobs, 
+                    time_budget=budget, local_search=self.local_search,
+                    prune=self.prune, warm_start=self.warm_start)
+                if not r.feasible:
+                    yield None, None, 0, time.time() - start
+                    continue
+                yield r, r.objective_function(), r.k, time.time() - start
+            return
+        budget = None
+        if deadline is not None:
+            # iterations run in waves of one per worker
+            budget = min(self.time_budget, 
+                self.time_budget * self._workers() / float(len(seeds)))
+        solved = maxp.solve_many(self.w, z, self.floor, floor_var_array, 
+            seeds, initial=self.initial, n_jobs=self._workers(), 
+            time_budget=budget, local_search=self.local_search,
+            prune=self.prune, warm_start=self.warm_start)
+        try:
+            for result in solved:
+                yield result
+                if deadline is not None and time.time() > deadline:
+                    return
+        finally:
+            solved.close()
+
     # helper function to assign weights to variables
     def _format_blobs(self, data):
         if self.method == 'default':
@@ -547,10 +840,11 @@ class Blobs:
     def build_data_structure(self, savedata=True):
         #build data structure
         sr = np.zeros([self.r.k, len(self.vars_to_use)*2+4])
+        id2pos = dict((area, i) for i, area in enumerate(self.r.w.id_order))
         for region in range(0,self.r.k):
             # blob ID
             sr[region][0] = region
-            selectionIDs = [self.r.w.id_order.index(i) for i in self.r.regions[region]]
+            selectionIDs = [id2pos[i] for i in self.r.regions[region]]
             m = self.r.z[selectionIDs, :]
             # objective function
             var = m.var(axis=0)
@@ -9,21 +9,358 @@ __author__ = "Serge Rey <srey@asu.edu>, David Folch <david.folch@asu.edu>"
 
 
 import pysal
-from components import check_contiguity
-import copy
 import random
+import math
+from collections import deque
+from functools import partial
 import numpy as np
 #from pysal.common import *
-from pysal.region import randomregion as RR
 import sys
+import time
+import ctypes
+import multiprocessing
+from multiprocessing import sharedctypes
 
-__all__ = ["Maxp", "Maxp_LISA"]
+__all__ = ["Maxp", "Maxp_LISA", "Descent", "TabuSearch", "SimulatedAnnealing",
+           "SharedData", "adjacency_arrays", "articulation_points",
+           "connected_components", "random_contiguous_partition", 
+           "solve_many"]
 
 LARGE = 10 ** 6
 MAX_ATTEMPTS = 100
+MAX_SEED = 2 ** 31 - 1
+TOLERANCE = 10 ** -9  # smallest change in wss counted as an improvement
+FIRST_CHUNK = 8  # moves scored together by first-improvement swapping
+CONSTRUCTION_SHARE = 0.5  # part of a time budget for initial solutions
+POLISH_SHARE = 0.2  # part of the time left to a search engine kept for the final descent
+INFERENCE_MEMORY = 2 ** 27  # bytes of work arrays per chunk of permutations
 
 
-class Maxp:
+def adjacency_arrays(w, id2pos=None):
+    """Compressed sparse row (CSR) form of the contiguity in a weights object.
+
+    Parameters
+    ----------
+
+    w           : W
+                  spatial weights object
+    id2pos      : dict
+                  mapping of area id to row position; built from
+                  w.id_order if not given
+
+    Returns
+    -------
+
+    offsets     : array
+                  (n+1) int32 vector; the neighbors of the area at position
+                  i are indices[offsets[i]:offsets[i+1]]
+    indices     : array
+                  int32 vector of neighbor positions
+
+    """
+    if id2pos is None:
+        id2pos = dict((area, i) for i, area in enumerate(w.id_order))
+    n = len(w.id_order)
+    offsets = np.zeros(n + 1, dtype=np.int32)
+    indices = []
+    for i, area in enumerate(w.id_order):
+        neighbors = [id2pos[neighbor] for neighbor in w.neighbors[area]]
+        indices.extend(neighbors)
+        offsets[i + 1] = offsets[i] + len(neighbors)
+    return offsets, np.array(indices, dtype=np.int32)
+
+
+def connected_components(offsets, indices):
+    """Connected components of a contiguity graph in CSR form.
+
+    Parameters
+    ----------
+
+    offsets     : array
+                  (n+1) vector of row offsets, see adjacency_arrays
+    indices     : array
+                  vector of neighbor positions, see adjacency_arrays
+
+    Returns
+    -------
+
+    components  : array
+                  n*1 int32 vector with the component of each area,
+                  numbered in order of their first area
+
+    """
+    n = len(offsets) - 1
+    components = [-1] * n
+    bounds = offsets.tolist()
+    indices = indices.tolist()
+    c = 0
+    for root in range(n):
+        if components[root] >= 0:
+            continue
+        components[root] = c
+        stack = [root]
+        while stack:
+            area = stack.pop()
+            for neighbor in indices[bounds[area]:bounds[area + 1]]:
+                if components[neighbor] < 0:
+                    components[neighbor] = c
+                    stack.append(neighbor)
+        c += 1
+    return np.array(components, dtype=np.int32)
+
+
+def random_contiguous_partition(neighbors, cards, rng, maxiter=1000):
+    """Random partition of areas into contiguous regions of given sizes.
+
+    Regions are grown together from random seeds until every area is
+    assigned, then matched to the sizes in cards by rank. Regions that are
+    too large pass areas along a shortest chain of adjacent regions to one
+    that is too small, never breaking a region apart, until every region
+    has its size. An attempt only fails if that balancing gets stuck.
+
+    Parameters
+    ----------
+
+    neighbors   : list
+                  neighbors[i] is the list of positions adjacent to area i
+    cards       : list
+                  number of areas in each region
+    rng         : random.Random
+                  random number generator
+    maxiter     : int
+                  maximum number of attempts
+
+    Returns
+    -------
+
+    order       : list
+                  positions of all areas, region by region in the order of
+                  cards, or None if no attempt succeeded
+
+    Examples
+    --------
+
+    Split a 6x6 lattice into regions of 3, 5, 8, 8 and 12 areas, with 20
+    different random streams. Every partition covers each area once and
+    has regions of exactly those sizes, each of them contiguous.
+
+    >>> import random
+    >>> import numpy as np
+    >>> import pysal
+    >>> from pysal.region.components import is_component
+    >>> w = pysal.lat2W(6, 6)
+    >>> neighbors = [w.neighbors[i] for i in w.id_order]
+    >>> cards = [3, 5, 8, 8, 12]
+    >>> def valid(order):
+    ...     regions = np.split(np.array(order), np.cumsum(cards)[:-1])
+    ...     sizes = [len(region) for region in regions]
+    ...     contiguous = [is_component(w, r.tolist()) for r in regions]
+    ...     return sorted(order) == range(w.n) and sizes == cards and all(contiguous)
+    >>> rngs = [random.Random(seed) for seed in range(20)]
+    >>> all(valid(random_contiguous_partition(neighbors, cards, rng)) for rng in rngs)
+    True
+
+    """
+    for attempt in range(maxiter):
+        regions = _balanced_partition(neighbors, cards, rng)
+        if regions is not None:
+            return [area for region in regions for area in region]
+    return None
+
+
+def _balanced_partition(neighbors, cards, rng):
+    # one attempt of random_contiguous_partition; returns the regions in the
+    # order of cards, or None
+    n = len(neighbors)
+    p = len(cards)
+    labels = [-1] * n
+    members = [set() for r in range(p)]
+    frontier = []
+    for r, seed in enumerate(rng.sample(range(n), p)):
+        labels[seed] = r
+        members[r].add(seed)
+        frontier.extend((neighbor, r) for neighbor in neighbors[seed])
+    while frontier:
+        j = rng.randrange(len(frontier))
+        frontier[j], frontier[-1] = frontier[-1], frontier[j]
+        area, r = frontier.pop()
+        if labels[area] == -1:
+            labels[area] = r
+            members[r].add(area)
+            frontier.extend((neighbor, r) for neighbor in neighbors[area]
+                            if labels[neighbor] == -1)
+    if -1 in labels:
+        # a connected component of w without a seed
+        return None
+    # the largest region gets the largest size and so on, ties at random
+    by_size = sorted(range(p), key=lambda r: (len(members[r]), rng.random()))
+    by_card = sorted(range(p), key=lambda i: (cards[i], rng.random()))
+    target = [0] * p
+    card_of = [0] * p
+    for r, i in zip(by_size, by_card):
+        target[r] = cards[i]
+        card_of[i] = r
+    # articulation points of each region, and the areas that can leave it
+    # by adjacent region
+    cuts = {}
+    exits = {}
+    for step in range(4 * n):
+        over = [r for r in range(p) if len(members[r]) > target[r]]
+        if not over:
+            return [list(members[card_of[i]]) for i in range(p)]
+        rng.shuffle(over)
+        for start in over:
+            path = _path_to_short(neighbors, labels, members, target, cuts, 
+                                  exits, start)
+            if path is not None:
+                break
+        else:
+            return None
+        # pass one area down each link, starting at the short end, so every
+        # region on the way keeps its size
+        for k in range(len(path) - 1, 0, -1):
+            donor, receiver = path[k - 1], path[k]
+            movable = _exits(neighbors, labels, members, cuts, exits, 
+                             donor).get(receiver)
+            if not movable:
+                break
+            area = rng.choice(movable)
+            members[donor].discard(area)
+            members[receiver].add(area)
+            labels[area] = receiver
+            # the exits of both regions and their neighbors may change, the
+            # articulation points only of the two regions
+            for r in set(labels[neighbor] for neighbor in neighbors[area]):
+                exits.pop(r, None)
+            exits.pop(donor, None)
+            cuts.pop(donor, None)
+            cuts.pop(receiver, None)
+    return None
+
+
+def _exits(neighbors, labels, members, cuts, exits, region):
+    # areas of region that can leave it without splitting it, by the
+    # adjacent region they can join; cached in cuts and exits
+    if region not in exits:
+        found = {}
+        if len(members[region]) > 1:
+            if region not in cuts:
+                cuts[region] = articulation_points(list(members[region]), 
+                                                   neighbors, labels, region)
+            cut = cuts[region]
+            for area in members[region]:
+                if area in cut:
+                    continue
+                for neighbor in neighbors[area]:
+                    other = labels[neighbor]
+                    if other != region:
+                        movable = found.setdefault(other, [])
+                        if not movable or movable[-1] != area:
+                            movable.append(area)
+        exits[region] = found
+    return exits[region]
+
+
+def _path_to_short(neighbors, labels, members, target, cuts, exits, start):
+    # shortest chain of regions from start to one with fewer areas than its
+    # target, where each region can pass an area to the next
+    parent = {start: None}
+    queue = deque([start])
+    while queue:
+        r = queue.popleft()
+        if len(members[r]) < target[r]:
+            path = []
+            while r is not None:
+                path.append(r)
+                r = parent[r]
+            return path[::-1]
+        for s in _exits(neighbors, labels, members, cuts, exits, r):
+            if s not in parent:
+                parent[s] = r
+                queue.append(s)
+    return None
+
+
+def articulation_points(members, neighbors, labels, region):
+    """Areas of a region whose removal would split it into several pieces.
+
+    Uses a single iterative depth first search (Tarjan) over the subgraph
+    induced by the region.
+
+    Parameters
+    ----------
+
+    members     : list
+                  positions of the areas in the region
+    neighbors   : list
+                  neighbors[i] is the list of positions adjacent to area i
+    labels      : list
+                  region label of every area
+    region      : int
+                  label of the region being examined
+
+    Returns
+    -------
+
+    cut         : set
+                  positions of the articulation points of the region
+
+    Examples
+    --------
+
+    On a 3x3 lattice, a T made of the top row and the middle column falls
+    apart without the top middle area or the center.
+
+    >>> import pysal
+    >>> w = pysal.lat2W(3, 3)
+    >>> neighbors = [w.neighbors[i] for i in w.id_order]
+    >>> labels = [0, 0, 0, 1, 0, 1, 1, 0, 1]
+    >>> sorted(articulation_points([0, 1, 2, 4, 7], neighbors, labels, 0))
+    [1, 4]
+
+    """
+    disc = {}
+    low = {}
+    cut = set()
+    timer = 0
+    for root in members:
+        if root in disc:
+            continue
+        disc[root] = low[root] = timer
+        timer += 1
+        root_children = 0
+        stack = [(root, -1, iter(neighbors[root]))]
+        while stack:
+            node, parent, remaining = stack[-1]
+            descended = False
+            for neighbor in remaining:
+                if labels[neighbor] != region:
+                    continue
+                if neighbor not in disc:
+                    disc[neighbor] = low[neighbor] = timer
+                    timer += 1
+                    stack.append((neighbor, node, iter(neighbors[neighbor])))
+                    descended = True
+                    break
+                elif neighbor != parent and disc[neighbor] < low[node]:
+                    low[node] = disc[neighbor]
+            if descended:
+                continue
+            stack.pop()
+            if parent == -1:
+                continue
+            if low[node] < low[parent]:
+                low[parent] = low[node]
+            if parent == root:
+                root_children += 1
+            elif low[node] >= disc[parent]:
+                cut.add(parent)
+        if root_children > 1:
+            cut.add(root)
+    return cut
+
+
+class Maxp(object):
     """Try to find the maximum number of regions for a set of areas such that
     each region combines contiguous areas that satisfy a given threshold
     constraint.
@@ -53,22 +390,73 @@ class Maxp:
                       len(ids) is less than the number of observations, the
                       complementary ids are added to the end of seeds. Thus
                       the specified seeds get priority in the solution
+    seed            : int
+                      seed for the solver's own random number generators;
+                      if None the global random and numpy.random states are
+                      used
+    n_jobs          : int
+                      number of worker processes building initial solutions;
+                      -1 uses all CPU cores
+    time_budget     : float
+                      seconds the solve may take. up to half of it is spent
+                      building initial solutions (always at least one) and
+                      the rest swapping; when it runs out the best solution
+                      so far is returned
+    prune           : bool
+                      rank initial solutions by number of regions first and
+                      wss second, and abandon a construction as soon as it
+                      can no longer reach the best number of regions so far
+    warm_start      : dict or array
+                      a partition to start from instead of building initial
+                      solutions, e.g. the area2region or labels of a solve on
+                      similar data. its regions are split into contiguous
+                      pieces, pieces below the floor are dissolved and
+                      regrown, and swapping starts from the result. areas
+                      missing from a dict, or labelled -1, are regrown too
+    local_search    : {None, 'descent', 'first', 'sample', 'tabu',
+                       'annealing'} or engine
+                      local search applied to the best initial solution:
+                      steepest descent swapping (None, the default), descent
+                      with first-improvement or sampled moves, tabu search
+                      or simulated annealing, or a configured Descent,
+                      TabuSearch or SimulatedAnnealing instance
 
     Attributes
     ----------
 
+    labels          : array
+                      n*1 int32 vector with the region of each area, in
+                      w.id_order order. this is the stored solution; the
+                      two attributes below are built from it on first use
     area2region     : dict
                       mapping of areas to region. key is area id, value is
                       region id
     regions         : list
                       list of lists of regions (each list has the ids of areas
-                      in that region)
+                      in that region, in w.id_order order)
     p               : int
                       number of regions
+    p_max           : int
+                      upper bound on p: the sum over the connected
+                      components of w of the (positive) floor variable in
+                      the component divided by floor, rounded down
     swap_iterations : int
                       number of swap iterations
     total_moves     : int
                       number of moves into internal regions
+    timed_out       : bool
+                      True if swapping was cut short by time_budget
+    warm_started    : bool
+                      True if the solve started from the repaired warm_start
+    pruned          : int
+                      number of constructions abandoned with prune
+    search_moves    : int
+                      moves made by a tabu or annealing search, before the
+                      final descent swap
+    evaluations     : int
+                      number of candidate moves scored by the local search
+    evaluations_per_move : float
+                      candidate moves scored per move made
 
     Examples
     --------
@@ -108,9 +496,23 @@ class Maxp:
     [4, 14, 5, 24, 3]
     >>>
 
+    With prune, constructions that can no longer reach the best number of
+    regions so far are abandoned, also when worker processes build them.
+
+    >>> import maxp
+    >>> w = pysal.lat2W(40, 40)
+    >>> z = np.random.RandomState(0).random_sample((w.n, 2))
+    >>> p = np.random.RandomState(1).random_sample(w.n) * 10000
+    >>> solution = maxp.Maxp(w, z, 30000, p, initial=20, seed=3, prune=True,
+    ...                      n_jobs=2)
+    >>> solution.pruned > 0
+    True
+
     """
     def __init__(self, w, z, floor, floor_variable,
-                 verbose=False, initial=100, seeds=[], myverbose=False):
+                 verbose=False, initial=100, seeds=[], myverbose=False,
+                 seed=None, n_jobs=1, time_budget=None, local_search=None,
+                 prune=False, warm_start=None):
 
         self.w = w
         self.z = z
@@ -119,133 +521,391 @@ class Maxp:
         self.verbose = verbose
         self.myverbose = myverbose
         self.seeds = seeds
-        self.initial_solution()
-        if not self.p:
-            self.feasible = False
+        self.n_jobs = n_jobs
+        self.local_search = local_search
+        self.prune = prune
+        self.warm_start = warm_start
+        self._seed_random(seed)
+        self._setup()
+        self._solve(initial, time_budget)
+        if self.feasible:
+            self._export()
+
+    def _solve(self, initial, time_budget=None):
+        self._start_clock(time_budget)
+        # every initial solution gets its own random stream, so they can be
+        # built in any order by any number of worker processes
+        build_seeds = [self._random.randint(0, MAX_SEED) for i in range(initial + 1)]
+        self.feasible = False
+        self.initial_wss = []
+        self.attempts = 0
+        self.pruned = 0
+        self.warm_started = False
+        self._incumbent.value = 0
+        if self._short_components:
+            # some areas can never reach the floor: fail without building
+            self.p = 0
+            print 'No initial solution found:', self._short_components, \
+                'connected component(s) of w fall short of the floor'
+            return
+        builds = self._starts(build_seeds)
+        for i, labels in enumerate(builds):
+            if labels is None:
+                if i == 0:
+                    break
+                continue
+            # score the labels directly, only the best one gets the lists
+            # the local search works on
+            p = int(labels.max()) + 1
+            val = self._labels_wss(labels, p)
+            if i == 0:
+                self.feasible = True
+                best_val = val
+                best_labels = labels
+                self._incumbent.value = p
+                if self._build_deadline is not None and time.time() > self._build_deadline:
+                    break
+                continue
+            self.initial_wss.append(val)
+            if self.verbose:
+                print '\n initial solution:', i - 1, val, best_val
+            if self.myverbose:
+                print 'initial solution:', i - 1, str(round(val,2)), \
+                    str(round(best_val,2)), 'with', p, 'of at most', \
+                    self.p_max, 'regions'
+            if self.prune:
+                # rank by number of regions first, then by wss
+                better = p > self._incumbent.value or \
+                    (p == self._incumbent.value and val < best_val)
+            else:
+                better = val < best_val
+            if better:
+                best_labels = labels
+                best_val = val
+                self._incumbent.value = max(self._incumbent.value, p)
+            self.attempts += 1
+            if self._build_deadline is not None and time.time() > self._build_deadline:
+                # keep the rest of the budget for swapping
+                break
+        builds.close()
+        if not self.feasible:
+            self.p = 0
         else:
-            self.feasible = True
-            best_val = self.objective_function()
-            self.current_regions = copy.copy(self.regions)
-            self.current_area2region = copy.copy(self.area2region)
-            self.initial_wss = []
-            self.attempts = 0
-            for i in range(initial):
-                # print('\nBuilding solution ' + str(i+1) + '...')
-                self.initial_solution()
-                if self.p:
-                    val = self.objective_function()
-                    self.initial_wss.append(val)
-                    if self.verbose:
-                        print '\n initial solution:', i, val, best_val
-                    if self.myverbose:
-                        print 'initial solution:', i, str(round(val,2)), \
-                            str(round(best_val,2)), 'with', self.p, 'regions'
-                    if val < best_val:
-                        self.current_regions = copy.copy(self.regions)
-                        self.current_area2region = copy.copy(self.area2region)
-                        best_val = val
-                    self.attempts += 1
-            self.regions = copy.copy(self.current_regions)
-            self.p = len(self.regions)
-            self.area2region = self.current_area2region
-            if verbose:
-                print "smallest region ifs: ", min([len(region) for region in self.regions])
+            self._load_labels(best_labels)
+            if self.verbose:
+                print "smallest region ifs: ", min([len(region) for region in self._regions])
                 raw_input='wait'
 
-            self.swap()
+            self.evaluations = 0
+            self.search_moves = 0
+            self._search_engine().search(self)
+            moves = self.total_moves + self.search_moves
+            self.evaluations_per_move = self.evaluations / float(max(moves, 1))
+
+    def _search_engine(self):
+        if self.local_search is None:
+            return Descent()
+        if isinstance(self.local_search, basestring):
+            return LOCAL_SEARCH[self.local_search]()
+        return self.local_search
+
+    @classmethod
+    def _unsolved(cls, w, z, floor, floor_variable):
+        # a set up instance without any solution, for rebuilding solutions
+        solution = cls.__new__(cls)
+        solution.w = w
+        solution.z = z
+        solution.floor = floor
+        solution.floor_variable = floor_variable
+        solution.verbose = False
+        solution.myverbose = False
+        solution.seeds = []
+        solution.n_jobs = 1
+        solution.local_search = None
+        solution.prune = False
+        solution.warm_start = None
+        solution.evaluations = 0
+        solution._seed_random(None)
+        solution._start_clock(None)
+        solution._setup()
+        return solution
+
+    @classmethod
+    def _attached(cls, shared, floor, seed_positions=[], prune=False):
+        # a solver working directly on the arrays of a SharedData block, as
+        # held by each worker process. it has no ids, only positions
+        solution = cls.__new__(cls)
+        solution.w = None
+        solution.z = None
+        solution.floor = floor
+        solution.floor_variable = None
+        solution.verbose = False
+        solution.myverbose = False
+        solution.seeds = []
+        solution.n_jobs = 1
+        solution.local_search = None
+        solution.prune = prune
+        solution.pruned = 0
+        solution.warm_start = None
+        solution.evaluations = 0
+        solution._seed_random(None)
+        solution._start_clock(None)
+        solution._ids = None
+        solution._id2pos = None
+        solution._seed_positions = seed_positions
+        solution._a2r = None
+        solution._regions = None
+        arrays = shared.attach()
+        solution._offsets = arrays['offsets']
+        solution._indices = arrays['indices']
+        solution._z = arrays['z']
+        solution._floor_var = arrays['floor_variable']
+        solution._incumbent = shared.incumbent
+        solution._derive(arrays['z2'], arrays['components'])
+        return solution
+
+    @classmethod
+    def from_labels(cls, w, z, floor, floor_variable, labels):
+        """Rebuild a solution from the region label of every area (in
+        w.id_order order) without solving, e.g. for labels returned by a
+        worker process."""
+        solution = cls._unsolved(w, z, floor, floor_variable)
+        solution._load_labels(labels)
+        solution.k = solution.p
+        solution.feasible = True
+        solution._export()
+        return solution
+
+    def _load_labels(self, labels):
+        self._a2r = np.asarray(labels).tolist()
+        self.p = max(self._a2r) + 1
+        self._regions = [[] for region in range(self.p)]
+        for area, region in enumerate(self._a2r):
+            self._regions[region].append(area)
+
+    def _construct(self, seed):
+        # build one initial solution on its own random stream; returns its
+        # labels as an int32 array, or None if no feasible solution was found
+        main = self._random, self._np_random
+        self._seed_random(seed)
+        try:
+            self.initial_solution()
+        finally:
+            self._random, self._np_random = main
+        if not self.p:
+            return None
+        return np.array(self._a2r, dtype=np.int32)
+
+    def _starts(self, build_seeds):
+        # yield the labels of the solutions to choose the start of the local
+        # search from: the repaired warm start alone if there is one
+        if self.warm_start is not None:
+            labels = self._repair(self.warm_start)
+            if labels is not None:
+                self.warm_started = True
+                yield labels
+                return
+        builds = self._initial_labels(build_seeds)
+        try:
+            for labels in builds:
+                yield labels
+        finally:
+            builds.close()
+
+    def _initial_labels(self, build_seeds):
+        # yield the labels of the initial solution for each seed, in order,
+        # building them in a process pool if n_jobs allows. workers prune
+        # against the shared incumbent, which _solve raises as builds come in
+        workers = _workers(self.n_jobs, len(build_seeds))
+        if workers == 1:
+            for seed in build_seeds:
+                yield self._construct(seed)
+            return
+        shared = SharedData(self._offsets, self._indices, self._z, self._floor_var,
+                            self._components)
+        shared.incumbent.value = self._incumbent.value
+        self._incumbent = shared.incumbent
+        results = _pool_imap(workers, shared, self.floor, self._seed_positions, 
+                             _build_initial, build_seeds, self.prune)
+        try:
+            for labels, pruned in results:
+                self.pruned += pruned
+                yield labels
+        finally:
+            results.close()
+
+    def _seed_random(self, seed):
+        if seed is None:
+            self._random = random
+            self._np_random = np.random
+        else:
+            self._random = random.Random(seed)
+            self._np_random = np.random.RandomState(seed)
+
+    def _setup(self):
+        # map area ids to dense row positions once; every phase below works
+        # on positions and region labels, ids only reappear in _export
+        self._ids = list(self.w.id_order)
+        self._id2pos = dict((area, i) for i, area in enumerate(self._ids))
+        self._seed_positions = [self._id2pos[i] for i in self.seeds]
+        self._a2r = None
+        self._regions = None
+        self._offsets, self._indices = adjacency_arrays(self.w, self._id2pos)
+        self._z = np.asarray(self.z, dtype=float)
+        if self._z.ndim == 1:
+            self._z = self._z.reshape((-1, 1))
+        self._floor_var = np.asarray(self.floor_variable, dtype=float).ravel()
+        self._incumbent = sharedctypes.RawValue(ctypes.c_int, 0)
+        self._derive()
+
+    def _derive(self, z2=None, components=None):
+        # working structures derived from the core arrays. worker processes
+        # pass in the ones the parent derived into shared memory, and build
+        # the neighbor lists only once a search needs them
+        self._neighbor_lists = None
+        if z2 is None:
+            z2 = self._z * self._z
+        self._z2 = z2
+        self._analyse_floor(components)
+
+    @property
+    def _neighbors(self):
+        # neighbor positions of each area as python lists, for the loops
+        # that grow and search regions
+        if self._neighbor_lists is None:
+            indices = self._indices.tolist()
+            bounds = self._offsets.tolist()
+            self._neighbor_lists = [indices[bounds[i]:bounds[i + 1]]
+                                    for i in range(len(bounds) - 1)]
+        return self._neighbor_lists
+
+    def _analyse_floor(self, components=None):
+        # regions are contiguous, so each lies within one connected component
+        # of w and needs floor out of the positive floor variable there
+        if components is None:
+            components = connected_components(self._offsets, self._indices)
+        self._components = components
+        self._positive_floor = np.maximum(self._floor_var, 0)
+        self._component_floor = np.bincount(self._components, 
+                                            weights=self._positive_floor)
+        if self.floor > 0:
+            short = self._component_floor < self.floor - TOLERANCE
+            self._short_components = int(short.sum())
+            self.p_max = int(self._region_bound(self._component_floor).sum())
+        else:
+            self._short_components = 0
+            self.p_max = len(self._floor_var)
+
+    def _region_bound(self, floor_totals):
+        # most regions that floor totals of positive floor variable can hold
+        return np.floor((floor_totals + TOLERANCE) / self.floor)
+
+    def _export(self):
+        # the int32 labels become the solution; regions and area2region are
+        # derived from them on demand. the working lists and search indexes
+        # are dropped and rebuilt from labels if the search is resumed
+        ids = self._ids
+        self.labels = np.array(self._a2r, dtype=np.int32)
+        self.enclaves = [ids[i] for i in getattr(self, '_enclaves', [])]
+        self._regions = None
+        self._a2r = None
+        self._touch = None
+        self._border = None
+        self._cut_areas = {}
+
+    @property
+    def regions(self):
+        """list of lists with the ids of the areas in each region"""
+        views = self._views()
+        if 'regions' not in views:
+            ids = self._ids
+            order = np.argsort(self.labels, kind='mergesort')
+            ends = np.cumsum(np.bincount(self.labels, minlength=self.p))[:-1]
+            views['regions'] = [[ids[i] for i in members] for members in 
+                                np.split(order, ends)]
+        return views['regions']
+
+    @property
+    def area2region(self):
+        """dict mapping each area id to its region"""
+        views = self._views()
+        if 'area2region' not in views:
+            views['area2region'] = dict(zip(self._ids, self.labels.tolist()))
+        return views['area2region']
+
+    def _views(self):
+        # lists and dicts derived from labels, kept until labels is replaced
+        cached = getattr(self, '_view_cache', None)
+        if cached is None or cached[0] is not self.labels:
+            cached = self._view_cache = (self.labels, {})
+        return cached[1]
 
     def initial_solution(self):
         self.p = 0
+        if self._short_components:
+            return
         solving = True
         attempts = 0
+        n = len(self._floor_var)
         while solving and attempts <= MAX_ATTEMPTS:
             regions = []
             enclaves = []
-            if not self.seeds:
-                candidates = copy.copy(self.w.id_order)
-                candidates = np.random.permutation(candidates)
+            if not self._seed_positions:
+                candidates = self._np_random.permutation(n)
                 candidates = candidates.tolist()
             else:
-                seeds = copy.copy(self.seeds)
-                nonseeds = [i for i in self.w.id_order if i not in seeds]
+                seeds = list(self._seed_positions)
+                seeded = set(seeds)
+                nonseeds = [i for i in range(n) if i not in seeded]
                 candidates = seeds
                 candidates.extend(nonseeds)
-            j = copy.copy(len(candidates))  # JG
+            candidates = deque(candidates)
+            assigned = [False] * n
+            n_assigned = 0
+            # positive floor variable left unassigned in each component
+            unassigned_floor = self._component_floor.copy()
             while candidates:
-                seed = candidates.pop(0)
+                seed = candidates.popleft()
+                if assigned[seed]:
+                    # already taken while growing an earlier region
+                    continue
+                if self.prune and self._cannot_beat(len(regions), unassigned_floor):
+                    # this start can no longer reach the best p so far
+                    self.pruned += 1
+                    self.p = 0
+                    return
                 if self.verbose:
-                    sys.stdout.write('\r' + str(len(regions)) + ' blobs formed (' + 
-                        str(round((j - len(candidates))/float(j)*100,1)) + '% complete)')  # JG
+                    sys.stdout.write('\r' + str(len(regions)) + ' of at most ' + 
+                        str(self.p_max) + ' blobs formed (' + 
+                        str(round(n_assigned/float(n)*100,1)) + '% complete)')  # JG
                     sys.stdout.flush()  # JG
                 # try to grow it till threshold constraint is satisfied
-                region = [seed]
-                building_region = True
-                while building_region:
-                    # check if floor is satisfied
-                    if self.check_floor(region):
-                        regions.append(region)
-                        building_region = False
-                    else:
-                        potential = []
-                        for area in region:
-                            neighbors = self.w.neighbors[area]
-                            neighbors = [neigh for neigh in neighbors if neigh in candidates]
-                            neighbors = [neigh for neigh in neighbors if neigh not in region]
-                            neighbors = [neigh for neigh in neighbors if neigh not in potential]
-                            potential.extend(neighbors)
-                        if potential:
-                            # add a random neighbor
-                            neigID = random.randint(0, len(potential) - 1)
-                            neigAdd = potential.pop(neigID)
-                            region.append(neigAdd)
-                            # remove it from candidates
-                            candidates.remove(neigAdd)
-                        else:
-                            #print 'enclave'
-                            #print region
-                            enclaves.extend(region)
-                            building_region = False
+                region, complete = self._grow_region(seed, assigned)
+                n_assigned += len(region)
+                if self.prune:
+                    for area in region:
+                        unassigned_floor[self._components[area]] -= \
+                            self._positive_floor[area]
+                if complete:
+                    regions.append(region)
+                else:
+                    #print 'enclave'
+                    #print region
+                    enclaves.extend(region)
             # check to see if any regions were made before going to enclave stage
-            if regions:
-                feasible = True
-            else:
+            if not regions:
                 attempts += 1
                 break
-            self.enclaves = enclaves[:]
-            a2r = {}
+            self._enclaves = enclaves[:]
+            a2r = [-1] * n
             for r, region in enumerate(regions):
                 for area in region:
                     a2r[area] = r
-            encCount = len(enclaves)
-            encAttempts = 0
-            while enclaves and encAttempts != encCount:
-                enclave = enclaves.pop(0)
-                neighbors = self.w.neighbors[enclave]
-                neighbors = [neighbor for neighbor in neighbors if neighbor not in enclaves]
-                candidates = []
-                for neighbor in neighbors:
-                    region = a2r[neighbor]
-                    if region not in candidates:
-                        candidates.append(region)
-                if candidates:
-                    # add enclave to random region
-                    regID = random.randint(0, len(candidates) - 1)
-                    rid = candidates[regID]
-                    regions[rid].append(enclave)
-                    a2r[enclave] = rid
-                    # structure to loop over enclaves until no more joining is possible
-                    encCount = len(enclaves)
-                    encAttempts = 0
-                    feasible = True
-                else:
-                    # put back on queue, no contiguous regions yet
-                    enclaves.append(enclave)
-                    encAttempts += 1
-                    feasible = False
+            feasible = self._assign_enclaves(regions, a2r, enclaves)
             if feasible:
                 solving = False
-                self.regions = regions
-                self.area2region = a2r
+                self._regions = regions
+                self._a2r = a2r
                 self.p = len(regions)
             else:
                 if attempts == MAX_ATTEMPTS:
@@ -256,19 +916,193 @@ class Maxp:
                     str(len(regions)) + ' regions\n'
                 attempts += 1
 
-    def swap(self):
+    def _grow_region(self, seed, assigned):
+        # grow a region from seed over unassigned areas, adding random
+        # adjacent ones until it meets the floor. marks its areas as assigned
+        # and returns them with whether the floor was met
+        assigned[seed] = True
+        region = [seed]
+        region_floor = self._floor_var[seed]
+        # unassigned areas adjacent to the region, as a list for uniform
+        # random picks and a set for membership tests
+        potential = []
+        frontier = set()
+        for neigh in self._neighbors[seed]:
+            if not assigned[neigh] and neigh not in frontier:
+                frontier.add(neigh)
+                potential.append(neigh)
+        while region_floor < self.floor:
+            if not potential:
+                return region, False
+            # add a random neighbor
+            neigID = self._random.randint(0, len(potential) - 1)
+            potential[neigID], potential[-1] = potential[-1], potential[neigID]
+            neigAdd = potential.pop()
+            frontier.discard(neigAdd)
+            region.append(neigAdd)
+            region_floor += self._floor_var[neigAdd]
+            assigned[neigAdd] = True
+            for neigh in self._neighbors[neigAdd]:
+                if not assigned[neigh] and neigh not in frontier:
+                    frontier.add(neigh)
+                    potential.append(neigh)
+        return region, True
+
+    def _repair(self, warm_start):
+        # turn a partition from another solve into a feasible solution for
+        # the current data: split its regions into contiguous pieces, keep
+        # the pieces that meet the floor and rebuild over the rest. returns
+        # labels, or None if no piece could be kept
+        n = len(self._floor_var)
+        if isinstance(warm_start, dict):
+            old = [warm_start.get(area) for area in self._ids]
+        else:
+            old = np.asarray(warm_start).ravel().tolist()
+            if len(old) != n:
+                raise ValueError('warm_start has %d labels for %d areas' % 
+                                 (len(old), n))
+        seen = [False] * n
+        regions = []
+        free = []
+        for root in range(n):
+            if seen[root]:
+                continue
+            seen[root] = True
+            piece = [root]
+            label = old[root]
+            if label is not None and label != -1:
+                stack = [root]
+                while stack:
+                    area = stack.pop()
+                    for neighbor in self._neighbors[area]:
+                        if not seen[neighbor] and old[neighbor] == label:
+                            seen[neighbor] = True
+                            piece.append(neighbor)
+                            stack.append(neighbor)
+                if self._check_floor(piece):
+                    regions.append(piece)
+                    continue
+            free.extend(piece)
+        if not regions:
+            return None
+        return self._rebuild(regions, free)
+
+    def _rebuild(self, regions, free):
+        # grow new regions over the free areas around fixed regions, then
+        # join what is left to adjacent regions as enclaves. returns labels,
+        # or None if some enclaves cannot reach a region
+        n = len(self._floor_var)
+        assigned = [True] * n
+        for area in free:
+            assigned[area] = False
+        free = list(free)
+        self._random.shuffle(free)
+        enclaves = []
+        for seed in free:
+            if assigned[seed]:
+                continue
+            region, complete = self._grow_region(seed, assigned)
+            if complete:
+                regions.append(region)
+            else:
+                enclaves.extend(region)
+        a2r = [-1] * n
+        for r, region in enumerate(regions):
+            for area in region:
+                a2r[area] = r
+        if not self._assign_enclaves(regions, a2r, enclaves):
+            return None
+        self._enclaves = enclaves
+        return np.array(a2r, dtype=np.int32)
+
+    def _cannot_beat(self, p, unassigned_floor):
+        # every further region needs at least floor of the unassigned floor
+        # variable in its component, which bounds the p this construction
+        # can still reach
+        if self.floor <= 0:
+            return False
+        bound = p + int(self._region_bound(unassigned_floor).sum())
+        return bound < self._incumbent.value
+
+    def _assign_enclaves(self, regions, a2r, enclaves):
+        # join each enclave to a random adjacent region. enclaves wait on a
+        # worklist until one of their neighbors is assigned, so each one is
+        # looked at again only when that can change its options. returns
+        # False if some enclaves can never reach a region
+        neighbors = self._neighbors
+        assigned_neighbors = dict((enclave, 0) for enclave in enclaves)
+        ready = deque()
+        for enclave in enclaves:
+            for neighbor in neighbors[enclave]:
+                if a2r[neighbor] != -1:
+                    assigned_neighbors[enclave] += 1
+            if assigned_neighbors[enclave]:
+                ready.append(enclave)
+        remaining = len(enclaves)
+        while ready:
+            enclave = ready.popleft()
+            candidates = []
+            for neighbor in neighbors[enclave]:
+                region = a2r[neighbor]
+                if region != -1 and region not in candidates:
+                    candidates.append(region)
+            # add enclave to random region
+            regID = self._random.randint(0, len(candidates) - 1)
+            rid = candidates[regID]
+            regions[rid].append(enclave)
+            a2r[enclave] = rid
+            remaining -= 1
+            for neighbor in neighbors[enclave]:
+                if a2r[neighbor] == -1:
+                    assigned_neighbors[neighbor] += 1
+                    if assigned_neighbors[neighbor] == 1:
+                        ready.append(neighbor)
+        return remaining == 0
+
+    def swap(self, strategy='best', sample_size=10, regions=None):
+        """Steepest descent swapping of boundary areas between regions.
+
+        Parameters
+        ----------
+
+        strategy    : {'best', 'first', 'sample'}
+                      'best' scores every feasible move into a region and
+                      makes the best one; 'first' scores moves in random
+                      order and makes the first that improves; 'sample'
+                      makes the best of sample_size random feasible moves
+        sample_size : int
+                      number of moves scored per step with 'sample'
+        regions     : list
+                      labels of the regions swapping may change; the other
+                      regions are left as they are (all regions by default)
+
+        The result replaces the stored solution (labels, regions and
+        area2region).
+
+        """
+        self._swap(strategy, sample_size, regions)
+        self._export()
+
+    def _swap(self, strategy='best', sample_size=10, regions=None):
+        # swap on the working lists, leaving them live for the caller
         swapping = True
         swap_iteration = 0
         if self.verbose:
             print '\nBeginning swap on initial solution'
         total_moves = 0
-        self.k = len(self.regions)
+        self._init_search()
         changed_regions = [1] * self.k
         nr = range(self.k)
+        if regions is not None:
+            nr = sorted(regions)
+            self._movable = [False] * self.k
+            for region in nr:
+                self._movable[region] = True
+        change = 0.0
         while swapping:
             moves_made = 0
             regionIds = [r for r in nr if changed_regions[r]]
-            np.random.permutation(regionIds)
+            self._random.shuffle(regionIds)
             changed_regions = [0] * self.k
             swap_iteration += 1
             total_change = 0
@@ -276,55 +1110,21 @@ class Maxp:
             for seed in regionIds:
                 local_swapping = True
                 local_attempts = 0
-                while local_swapping:
+                while local_swapping and not self._out_of_time():
                     local_moves = 0
-                    # get neighbors
-                    members = self.regions[seed]
-                    neighbors = []
-                    for member in members:
-                        candidates = self.w.neighbors[member]
-                        candidates = [candidate for candidate in candidates if candidate not in members]
-                        candidates = [candidate for candidate in candidates if candidate not in neighbors]
-                        neighbors.extend(candidates)
-                    candidates = []
-                    for neighbor in neighbors:
-                        block = copy.copy(self.regions[self.area2region[
-                            neighbor]])
-                        if check_contiguity(self.w, block, neighbor):
-                            block.remove(neighbor)
-                            fv = self.check_floor(block)
-                            if fv:
-                                candidates.append(neighbor)
+                    candidates = self._candidates(seed)
                     # find the best local move
                     if not candidates:
                         local_swapping = False
                     else:
-                        nc = len(candidates)
-                        moves = np.zeros([nc, 1], float)
-                        best = None
-                        cv = 0.0
-                        for area in candidates:
-                            current_internal = self.regions[seed]
-                            current_outter = self.regions[self.area2region[
-                                area]]
-                            current = self.objective_function([current_internal, current_outter])
-                            new_internal = copy.copy(current_internal)
-                            new_outter = copy.copy(current_outter)
-                            new_internal.append(area)
-                            new_outter.remove(area)
-                            new = self.objective_function([new_internal,
-                                                           new_outter])
-                            change = new - current
-                            if change < cv:
-                                best = area
-                                cv = change
-                        if best:
+                        best, change = self._pick_move(candidates, seed, 
+                                                       strategy, sample_size)
+                        change = min(change, 0.0)
+                        if best is not None:
                             # make the move
                             area = best
-                            old_region = self.area2region[area]
-                            self.regions[old_region].remove(area)
-                            self.area2region[area] = seed
-                            self.regions[seed].append(area)
+                            old_region = self._a2r[area]
+                            self._apply_move(area, seed)
                             moves_made += 1
                             changed_regions[seed] = 1
                             changed_regions[old_region] = 1
@@ -336,19 +1136,19 @@ class Maxp:
                         total_change -= change
                     if self.myverbose:
                         print 'swap_iteration: ', swap_iteration, 'moves_made: ', moves_made
-                        print 'number of regions: ', len(self.regions)
+                        print 'number of regions: ', len(self._regions)
                         print 'number of changed regions: ', sum(
                             changed_regions)
                         print 'internal region: ', seed, 'local_attempts: ', local_attempts
                         print 'improvement: ', change
-                        print 'smallest region size: ',min([len(region) for region in self.regions])
+                        print 'smallest region size: ',min([len(region) for region in self._regions])
                     if self.verbose:
                         sys.stdout.write('\riter ' + str(swap_iteration) + ', ' + \
                             str(moves_made) + ' moves, improvement: ' + 
                             str(round(total_change,4)))
                         sys.stdout.flush()
             total_moves += moves_made
-            if moves_made == 0:
+            if moves_made == 0 or self.timed_out:
                 swapping = False
                 self.swap_iterations = swap_iteration
                 self.total_moves = total_moves
@@ -358,11 +1158,223 @@ class Maxp:
             if self.myverbose:
                 print '\n'
 
+    def _pick_move(self, candidates, region, strategy, sample_size):
+        # choose a move into region among candidates; returns the area (None
+        # if no move improves by more than TOLERANCE) and its change in wss
+        if strategy == 'first':
+            # score in random order, a few at a time to keep numpy busy
+            order = list(candidates)
+            self._random.shuffle(order)
+            for start in range(0, len(order), FIRST_CHUNK):
+                chunk = order[start:start + FIRST_CHUNK]
+                changes = self._move_deltas(chunk, region)
+                improving = np.flatnonzero(changes < -TOLERANCE)
+                if len(improving):
+                    j = improving[0]
+                    return chunk[j], changes[j]
+            return None, 0.0
+        if strategy == 'sample' and len(candidates) > sample_size:
+            candidates = self._random.sample(candidates, sample_size)
+        changes = self._move_deltas(candidates, region)
+        j = changes.argmin()
+        if changes[j] < -TOLERANCE:
+            return candidates[j], changes[j]
+        return None, changes[j]
+
+    def _init_search(self):
+        # set up the running statistics and boundary index used by moves
+        if self._a2r is None:
+            self._load_labels(self.labels)
+        self.k = len(self._regions)
+        self._init_stats()
+        self._init_border()
+        self._movable = None
+        self.timed_out = False
+
+    def _total_wss(self):
+        # wss of the current solution from the running statistics
+        return (self._ssq - self._sum * self._sum / self._count[:, None]).sum()
+
+    def _start_clock(self, time_budget):
+        # deadlines for the whole solve and for the construction phase
+        if time_budget is None:
+            self._deadline = None
+            self._build_deadline = None
+        else:
+            now = time.time()
+            self._deadline = now + time_budget
+            self._build_deadline = now + time_budget * CONSTRUCTION_SHARE
+
+    def _hold_back(self, share):
+        # bring the deadline forward so that share of the time left stays
+        # for a later phase; returns the deadline to restore for that phase
+        deadline = self._deadline
+        if deadline is not None:
+            now = time.time()
+            self._deadline = now + max(deadline - now, 0) * (1 - share)
+        return deadline
+
+    def _out_of_time(self):
+        if self._deadline is not None and time.time() > self._deadline:
+            self.timed_out = True
+        return self.timed_out
+
+    def _init_stats(self):
+        # per-region sufficient statistics (count, sum and sum of squares of
+        # z) so the wss of a region is sum(ssq - sum**2 / count), plus the
+        # running floor_variable total of each region
+        labels = np.asarray(self._a2r)
+        p = len(self._regions)
+        self._floor_total = np.bincount(labels, weights=self._floor_var, minlength=p)
+        self._cut_areas = {}
+        self._count, self._sum, self._ssq = self._region_stats(labels, p)
+
+    def _region_stats(self, labels, p):
+        # count, sum and sum of squares of z in each of p regions
+        count = np.bincount(labels, minlength=p).astype(float)
+        total = np.zeros((p, self._z.shape[1]))
+        ssq = np.zeros((p, self._z.shape[1]))
+        for v in range(self._z.shape[1]):
+            total[:, v] = np.bincount(labels, weights=self._z[:, v], minlength=p)
+            ssq[:, v] = np.bincount(labels, weights=self._z2[:, v], minlength=p)
+        return count, total, ssq
+
+    def _labels_wss(self, labels, p):
+        # wss of a label array from its region statistics
+        count, total, ssq = self._region_stats(labels, p)
+        used = count > 0
+        count = count[used][:, None]
+        return (ssq[used] - total[used] * total[used] / count).sum()
+
+    def _init_border(self):
+        # boundary index: _touch[a] counts the neighbors of area a in each
+        # region, _border[r][s] is the set of areas of region s adjacent to
+        # region r. _apply_move only updates the entries of the areas a move
+        # touches, so the swap loop can read a region's frontier directly
+        labels = self._a2r
+        self._touch = []
+        self._border = [{} for region in self._regions]
+        for area, neighbors in enumerate(self._neighbors):
+            touch = {}
+            for neighbor in neighbors:
+                region = labels[neighbor]
+                touch[region] = touch.get(region, 0) + 1
+            self._touch.append(touch)
+            for region in touch:
+                if region != labels[area]:
+                    self._border[region].setdefault(labels[area], set()).add(area)
+
+    def _border_remove(self, region, other, area):
+        frontier = self._border[region][other]
+        frontier.discard(area)
+        if not frontier:
+            del self._border[region][other]
+
+    def _region_wss(self, count, total, ssq):
+        if count <= 0:
+            return 0.0
+        return (ssq - total * total / count).sum()
+
+    def _candidates(self, region):
+        # areas of neighboring regions that can move into region without
+        # breaking the floor or the contiguity of the region they leave
+        candidates = []
+        for donor, frontier in self._border[region].items():
+            if self._movable is not None and not self._movable[donor]:
+                continue
+            slack = self._floor_total[donor] - self.floor
+            for neighbor in frontier:
+                if self._floor_var[neighbor] <= slack:
+                    if self._can_leave(neighbor, donor):
+                        candidates.append(neighbor)
+        return candidates
+
+    def _move_deltas(self, areas, dst):
+        # change in wss from moving each of areas, from whichever region it
+        # is in, into region dst; all candidates are scored in one pass
+        self.evaluations += len(areas)
+        areas = np.asarray(areas)
+        src = np.array([self._a2r[area] for area in areas])
+        x = self._z[areas]
+        x2 = self._z2[areas]
+        count = self._count[src]
+        total = self._sum[src]
+        ssq = self._ssq[src]
+        before = (ssq - total * total / count[:, None]).sum(axis=1)
+        left = count - 1
+        rest = total - x
+        after = (ssq - x2).sum(axis=1) - (rest * rest).sum(axis=1) / np.where(left > 0, left, 1)
+        after[left <= 0] = 0.0
+        n_dst = self._count[dst]
+        before += self._region_wss(n_dst, self._sum[dst], self._ssq[dst])
+        joined = self._sum[dst] + x
+        after += (self._ssq[dst] + x2).sum(axis=1) - (joined * joined).sum(axis=1) / (n_dst + 1)
+        return after - before
+
+    def _move_delta(self, area, src, dst):
+        # change in wss from moving area from region src to region dst, O(m)
+        self.evaluations += 1
+        x = self._z[area]
+        x2 = self._z2[area]
+        count, total, ssq = self._count, self._sum, self._ssq
+        before = self._region_wss(count[src], total[src], ssq[src]) + \
+            self._region_wss(count[dst], total[dst], ssq[dst])
+        after = self._region_wss(count[src] - 1, total[src] - x, ssq[src] - x2) + \
+            self._region_wss(count[dst] + 1, total[dst] + x, ssq[dst] + x2)
+        return after - before
+
+    def _apply_move(self, area, dst):
+        # move area into region dst, keeping the region statistics current
+        src = self._a2r[area]
+        self._regions[src].remove(area)
+        self._regions[dst].append(area)
+        self._a2r[area] = dst
+        self._floor_total[src] -= self._floor_var[area]
+        self._floor_total[dst] += self._floor_var[area]
+        self._cut_areas.pop(src, None)
+        self._cut_areas.pop(dst, None)
+        for region in self._touch[area]:
+            if region != src:
+                self._border_remove(region, src, area)
+            if region != dst:
+                self._border[region].setdefault(dst, set()).add(area)
+        for neighbor in self._neighbors[area]:
+            touch = self._touch[neighbor]
+            label = self._a2r[neighbor]
+            touch[src] -= 1
+            if not touch[src]:
+                del touch[src]
+                if label != src:
+                    self._border_remove(src, label, neighbor)
+            touch[dst] = touch.get(dst, 0) + 1
+            if touch[dst] == 1 and label != dst:
+                self._border[dst].setdefault(label, set()).add(neighbor)
+        x = self._z[area]
+        x2 = self._z2[area]
+        self._count[src] -= 1
+        self._sum[src] -= x
+        self._ssq[src] -= x2
+        self._count[dst] += 1
+        self._sum[dst] += x
+        self._ssq[dst] += x2
+
+    def _can_leave(self, area, region):
+        # area can leave region without breaking it apart if it is not one
+        # of the region's articulation points; these are found with one
+        # DFS per region and cached until the region changes
+        if len(self._regions[region]) < 2:
+            return False
+        if region not in self._cut_areas:
+            self._cut_areas[region] = articulation_points(
+                self._regions[region], self._neighbors, self._a2r, region)
+        return area not in self._cut_areas[region]
+
     def check_floor(self, region):
-        selectionIDs = [self.w.id_order.index(i) for int(i) in region]  # JG: int(i)
-        cv = sum(self.floor_variable[selectionIDs])
+        return self._check_floor([self._id2pos[i] for i in region])
+
+    def _check_floor(self, members):
+        cv = self._floor_var[members].sum()
         if cv >= self.floor:
-            #print len(selectionIDs)
             return True
         else:
             return False
@@ -372,35 +1384,156 @@ class Maxp:
         # that the first region has areas 1,7,2 the second region 0,4,3 and so
         # on. solution does not have to be exhaustive
         if not solution:
-            solution = self.regions
+            if self._a2r is not None:
+                return self._wss(self._regions)
+            return self._labels_wss(self.labels, self.p)
+        id2pos = self._id2pos
+        return self._wss([[id2pos[i] for i in region] for region in solution])
+
+    def _wss(self, regions):
+        # within sum of squares for regions given as lists of area positions
         wss = 0
-        j = 0
-        if self.verbose and len(solution)>2:
-            sys.stdout.write('\n')
-            sys.stdout.flush()
-        for region in solution:
-            j += 1
-            #if self.verbose and len(solution)>2:
-            #    sys.stdout.write('\rCalculating objective function (' + 
-            #        str(round(float(j) / len(solution) * 100, 0)) + '% complete)')  # JG
-            #    sys.stdout.flush()  # JG
-            selectionIDs = [self.w.id_order.index(i) for i in region]
-            m = self.z[selectionIDs, :]
+        for region in regions:
+            m = self._z[region, :]
             var = m.var(axis=0)
             wss += sum(np.transpose(var)) * len(region)
         return wss
 
-    def inference(self, nperm=99):
+    def update(self, z=None, floor_variable=None, changed=None, rebuilds=10):
+        """Re-solve after the data of some areas changed, leaving the regions
+        away from the changes as they are.
+
+        Regions holding a changed area are freed if they now fall below the
+        floor, or if that area could now move to an adjacent region and
+        lower the wss. The freed regions and their neighbors are rebuilt and
+        swapped; all other regions stay fixed and keep their labels, and the
+        rebuilt regions take the labels of the freed ones.
+
+        Parameters
+        ----------
+
+        z               : array
+                          n*m array of the new observations on all areas
+                          (None keeps the current ones)
+        floor_variable  : array
+                          n*1 vector of the new floor variable (None keeps
+                          the current one)
+        changed         : list
+                          ids of the areas whose data changed (None checks
+                          every area)
+        rebuilds        : int
+                          number of random rebuilds of the freed areas; the
+                          one with the most regions is swapped
+
+        Returns
+        -------
+
+        freed           : int
+                          number of regions that were rebuilt
+
+        """
+        if z is not None:
+            self.z = z
+            self._z = np.asarray(z, dtype=float)
+            if self._z.ndim == 1:
+                self._z = self._z.reshape((-1, 1))
+            self._z2 = self._z * self._z
+        if floor_variable is not None:
+            self.floor_variable = floor_variable
+            self._floor_var = np.asarray(floor_variable, dtype=float).ravel()
+            self._analyse_floor(self._components)
+        if self._short_components:
+            self.feasible = False
+            self.p = 0
+            print 'No solution found:', self._short_components, \
+                'connected component(s) of w fall short of the floor'
+            return 0
+        if changed is None:
+            positions = range(len(self._floor_var))
+        else:
+            positions = [self._id2pos[area] for area in changed]
+        self._start_clock(None)
+        self._init_search()
+        affected = set()
+        for area in positions:
+            region = self._a2r[area]
+            if region in affected:
+                continue
+            if self._floor_total[region] < self.floor:
+                affected.add(region)
+            elif self._floor_total[region] - self._floor_var[area] >= self.floor \
+                    and self._can_leave(area, region):
+                # a swap the current solution missed under the new data
+                for other in self._touch[area]:
+                    if other != region and \
+                            self._move_delta(area, region, other) < -TOLERANCE:
+                        affected.add(region)
+                        break
+        freed = set(affected)
+        for region in affected:
+            freed.update(self._border[region])
+        kept_labels = [r for r in range(self.k) if r not in freed]
+        kept = [list(self._regions[r]) for r in kept_labels]
+        free = []
+        for region in freed:
+            free.extend(self._regions[region])
+        n_kept = len(kept)
+        labels = None
+        for attempt in range(max(rebuilds, 1)):
+            # enclaves are appended to the regions passed in, so each attempt
+            # gets its own copy of the kept regions
+            rebuilt = self._rebuild([list(region) for region in kept], free)
+            if rebuilt is not None and (labels is None or rebuilt.max() > labels.max()):
+                labels = rebuilt
+                enclaves = self._enclaves
+        if labels is not None:
+            self._enclaves = enclaves
+            # rebuilt regions follow the kept ones in labels; give the kept
+            # regions back their own labels and the rebuilt ones the freed
+            # labels
+            targets = self._update_targets(kept_labels, sorted(freed), 
+                                           int(labels.max()) + 1 - n_kept)
+            labels = np.array(targets, dtype=np.int32)[labels]
+            rebuilt_labels = targets[n_kept:]
+        else:
+            # rebuild everything if the freed areas cannot be covered
+            labels = self._rebuild([], range(len(self._floor_var)))
+            rebuilt_labels = range(int(labels.max()) + 1)
+        self._load_labels(labels)
+        self._swap(regions=rebuilt_labels)
+        self.k = self.p
+        self.feasible = True
+        self._export()
+        return len(freed)
+
+    def _update_targets(self, kept_labels, freed_labels, n_rebuilt):
+        # new label of each kept region, then of each rebuilt one. rebuilt
+        # regions take the freed labels first and labels past the old ones
+        # after that. labels stay 0..p-1, so if fewer regions come back the
+        # kept regions with the highest labels fill the gaps
+        extra = range(self.k, self.k + n_rebuilt)
+        targets = kept_labels + (freed_labels + extra)[:n_rebuilt]
+        p = len(targets)
+        gaps = iter(sorted(set(range(p)) - set(targets)))
+        return [label if label < p else next(gaps) for label in targets]
+
+    def inference(self, nperm=99, max_memory=INFERENCE_MEMORY):
         """Compare the within sum of squares for the solution against
         simulated solutions where areas are randomly assigned to regions that
         maintain the cardinality of the original solution.
 
+        The simulated solutions are scored in chunks of permutations at once
+        from per-region sums of z, since with fixed cardinalities the wss is
+        a constant minus the sum over regions of sum(z)**2 / cardinality.
+
         Parameters
         ----------
 
         nperm       : int
                       number of random permutations for calculation of
                       pseudo-p_values
+        max_memory  : int
+                      bytes of work arrays used by each chunk of permutations
 
         Attributes
         ----------
@@ -434,31 +1567,41 @@ class Maxp:
         0.2
 
         """
-        ids = self.w.id_order
-        num_regions = len(self.regions)
+        n, m = self._z.shape
+        cards = np.bincount(self.labels, minlength=self.p)
+        starts = np.concatenate(([0], np.cumsum(cards)[:-1]))
         wsss = np.zeros(nperm + 1)
-        self.wss = self.objective_function()
-        cards = [len(i) for i in self.regions]
-        sim_solutions = RR.Random_Regions(ids, num_regions,
-                                          cardinality=cards, permutations=nperm)
-        cv = 1
-        c = 1
-        for solution in sim_solutions.solutions_feas:
-            wss = self.objective_function(solution.regions)
-            wsss[c] = wss
-            if wss <= self.wss:
-                cv += 1
-            c += 1
-        self.pvalue = cv / (1. + len(sim_solutions.solutions_feas))
+        # the solution itself is areas sorted by region
+        observed = np.argsort(self.labels, kind='mergesort')
+        self.wss = self._permutation_wss(observed[None, :], starts, cards)[0]
+        chunk = max(1, int(max_memory // (n * (m + 1) * 8)))
+        for first in range(1, nperm + 1, chunk):
+            size = min(chunk, nperm + 1 - first)
+            # the first cards[0] areas of each permutation form region 0 and
+            # so on, as in pysal.region.randomregion
+            orders = np.array([self._np_random.permutation(n) for i in range(size)])
+            wsss[first:first + size] = self._permutation_wss(orders, starts, cards)
+        self.pvalue = (1 + (wsss[1:] <= self.wss).sum()) / (1. + nperm)
         self.wss_perm = wsss
         self.wss_perm[0] = self.wss
 
-    def cinference(self, nperm=99, maxiter=1000):
+    def _permutation_wss(self, orders, starts, cards):
+        # wss of the partitions given by rows of area orders split into
+        # consecutive runs of cards areas
+        sums = np.add.reduceat(self._z[orders], starts, axis=1)
+        between = (sums * sums / cards[None, :, None]).sum(axis=2).sum(axis=1)
+        return (self._z2).sum() - between
+
+    def cinference(self, nperm=99, maxiter=1000, n_jobs=None,
+                   max_memory=INFERENCE_MEMORY):
         """Compare the within sum of squares for the solution against
         conditional simulated solutions where areas are randomly assigned to
         regions that maintain the cardinality of the original solution and
         respect contiguity relationships.
 
+        The simulated solutions come from random_contiguous_partition, one
+        random stream per permutation, in worker processes if n_jobs allows.
+
         Parameters
         ----------
 
@@ -469,6 +1612,13 @@ class Maxp:
         maxiter     : int
                       maximum number of attempts to find each permutation
 
+        n_jobs      : int
+                      number of worker processes generating permutations; -1
+                      uses all CPU cores (None by default: as for the solve)
+
+        max_memory  : int
+                      bytes of work arrays used by each chunk of permutations
+
         Attributes
         ----------
 
@@ -511,30 +1661,424 @@ class Maxp:
         0.1
 
         """
-        ids = self.w.id_order
-        num_regions = len(self.regions)
-        wsss = np.zeros(nperm + 1)
-        self.cwss = self.objective_function()
-        cards = [len(i) for i in self.regions]
-        sim_solutions = RR.Random_Regions(ids, num_regions,
-                                          cardinality=cards, contiguity=self.w,
-                                          maxiter=maxiter, permutations=nperm)
-        self.cfeas_sols = len(sim_solutions.solutions_feas)
+        cards = np.bincount(self.labels, minlength=self.p)
+        starts = np.concatenate(([0], np.cumsum(cards)[:-1]))
+        observed = np.argsort(self.labels, kind='mergesort')
+        self.cwss = self._permutation_wss(observed[None, :], starts, cards)[0]
+        # each permutation gets its own random stream, so they can be drawn
+        # by any number of worker processes
+        tasks = [(seed, cards.tolist(), maxiter) for seed in 
+                 self._np_random.randint(0, MAX_SEED, nperm)]
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        workers = _workers(n_jobs, nperm)
+        if workers == 1:
+            orders = [_contiguous_order(task, self._neighbors) for task in tasks]
+        else:
+            shared = SharedData(self._offsets, self._indices, self._z, 
+                                self._floor_var, self._components)
+            orders = list(_pool_imap(workers, shared, self.floor, [], 
+                                     _contiguous_order, tasks))
+        orders = [order for order in orders if order is not None]
+        self.cfeas_sols = len(orders)
         if self.cfeas_sols < nperm:
             raise Exception('not enough feasible solutions found')
-        cv = 1
-        c = 1
-        for solution in sim_solutions.solutions_feas:
-            wss = self.objective_function(solution.regions)
-            wsss[c] = wss
-            if wss <= self.cwss:
-                cv += 1
-            c += 1
-        self.cpvalue = cv / (1. + self.cfeas_sols)
+        wsss = np.zeros(nperm + 1)
+        n, m = self._z.shape
+        chunk = max(1, int(max_memory // (n * (m + 1) * 8)))
+        for first in range(0, nperm, chunk):
+            wsss[first + 1:first + 1 + chunk] = self._permutation_wss(
+                np.array(orders[first:first + chunk]), starts, cards)
+        self.cpvalue = (1 + (wsss[1:] <= self.cwss).sum()) / (1. + self.cfeas_sols)
         self.cwss_perm = wsss
         self.cwss_perm[0] = self.cwss
 
 
+class Descent(object):
+    """Steepest descent local search, the classic max-p swap phase.
+
+    Each changed region in turn takes improving areas from its neighbors
+    until no move improves the solution.
+
+    Parameters
+    ----------
+
+    strategy        : {'best', 'first', 'sample'}
+                      how the move made at each step is chosen: the best
+                      feasible move (the classic swap), the first improving
+                      move found in random order, or the best of a random
+                      sample of sample_size feasible moves
+    sample_size     : int
+                      moves scored per step with the 'sample' strategy
+
+    """
+    def __init__(self, strategy='best', sample_size=10):
+        self.strategy = strategy
+        self.sample_size = sample_size
+
+    def search(self, solver):
+        solver._swap(self.strategy, self.sample_size)
+
+
+class TabuSearch(object):
+    """Tabu search over the max-p move neighborhood.
+
+    Every iteration makes the best allowed move of a boundary area into a
+    neighboring region, even if it makes the solution worse. An area may
+    not move back into the region it just left for tenure iterations,
+    unless doing so gives a new best solution. The search starts from a
+    steepest descent local optimum, and the best solution found is then
+    polished with a steepest descent swap. The moves into each region are
+    kept ranked and only rescored for the regions a move touches.
+
+    Parameters
+    ----------
+
+    tenure          : int
+                      number of iterations a reverse move stays tabu
+    max_iterations  : int
+                      maximum number of moves
+    max_stall       : int
+                      stop after this many moves without a new best solution
+
+    """
+    def __init__(self, tenure=10, max_iterations=1000, max_stall=100):
+        self.tenure = tenure
+        self.max_iterations = max_iterations
+        self.max_stall = max_stall
+
+    def _ranked_moves(self, solver, region):
+        # (area, change) of the feasible moves into region, best first
+        candidates = solver._candidates(region)
+        if not candidates:
+            return []
+        changes = solver._move_deltas(candidates, region)
+        return [(candidates[j], changes[j]) for j in 
+                np.argsort(changes, kind='mergesort')]
+
+    def search(self, solver):
+        solver._swap()
+        deadline = solver._hold_back(POLISH_SHARE)
+        current = best = solver._total_wss()
+        best_labels = np.array(solver._a2r, dtype=np.int32)
+        ranked = [self._ranked_moves(solver, region) for region in range(solver.p)]
+        tabu = {}
+        stall = 0
+        moves = 0
+        for iteration in xrange(self.max_iterations):
+            if solver._out_of_time():
+                break
+            move = None
+            for region, region_moves in enumerate(ranked):
+                for area, change in region_moves:
+                    if move is not None and change >= move[2]:
+                        break
+                    if tabu.get((area, region), -1) >= iteration and \
+                            current + change >= best - TOLERANCE:
+                        continue
+                    move = (area, region, change)
+                    break
+            if move is None:
+                break
+            area, region, change = move
+            src = solver._a2r[area]
+            tabu[(area, src)] = iteration + self.tenure
+            # moves change with the statistics, floor slack and articulation
+            # points of the two regions, so only moves into them and their
+            # neighbors are rescored
+            touched = set([src, region])
+            touched.update(solver._border[src], solver._border[region])
+            solver._apply_move(area, region)
+            touched.update(solver._border[src], solver._border[region])
+            for other in touched:
+                ranked[other] = self._ranked_moves(solver, other)
+            moves += 1
+            current += change
+            if current < best - TOLERANCE:
+                best = current
+                best_labels = np.array(solver._a2r, dtype=np.int32)
+                stall = 0
+            else:
+                stall += 1
+                if stall >= self.max_stall:
+                    break
+        solver.search_moves = moves
+        solver._deadline = deadline
+        solver._load_labels(best_labels)
+        solver._swap()
+
+
+class SimulatedAnnealing(object):
+    """Simulated annealing over the max-p move neighborhood.
+
+    Proposes a random feasible move of a boundary area into a random
+    region and accepts it with the Metropolis rule at a temperature that
+    is lowered geometrically. The search starts from a steepest descent
+    local optimum, and the best solution found is then polished with a
+    steepest descent swap.
+
+    Parameters
+    ----------
+
+    temperature     : float
+                      starting temperature; by default set so that an
+                      average worsening move is accepted half of the time
+    cooling         : float
+                      factor applied to the temperature after each round
+    moves           : int
+                      proposals per temperature; by default the number of
+                      areas
+    min_ratio       : float
+                      stop once the temperature falls below this share of
+                      the starting temperature
+
+    """
+    def __init__(self, temperature=None, cooling=0.9, moves=None, min_ratio=0.001):
+        self.temperature = temperature
+        self.cooling = cooling
+        self.moves = moves
+        self.min_ratio = min_ratio
+
+    def _propose(self, solver):
+        region = solver._random.randrange(solver.p)
+        candidates = solver._candidates(region)
+        if not candidates:
+            return None
+        area = solver._random.choice(candidates)
+        return area, region, solver._move_delta(area, solver._a2r[area], region)
+
+    def _start_temperature(self, solver):
+        # half acceptance for the average worsening move in a sample
+        worse = []
+        for i in range(100):
+            move = self._propose(solver)
+            if move is not None and move[2] > 0:
+                worse.append(move[2])
+        if not worse:
+            return TOLERANCE
+        return np.mean(worse) / math.log(2)
+
+    def search(self, solver):
+        solver._swap()
+        deadline = solver._hold_back(POLISH_SHARE)
+        current = best = solver._total_wss()
+        best_labels = np.array(solver._a2r, dtype=np.int32)
+        temperature = self.temperature or self._start_temperature(solver)
+        coldest = temperature * self.min_ratio
+        rounds = self.moves or len(solver._a2r)
+        moves = 0
+        while temperature > coldest and not solver._out_of_time():
+            accepted = 0
+            for step in xrange(rounds):
+                move = self._propose(solver)
+                if move is None:
+                    continue
+                area, region, change = move
+                if change < 0 or solver._random.random() < math.exp(-change / temperature):
+                    solver._apply_move(area, region)
+                    accepted += 1
+                    current += change
+                    if current < best - TOLERANCE:
+                        best = current
+                        best_labels = np.array(solver._a2r, dtype=np.int32)
+                if solver._out_of_time():
+                    break
+            moves += accepted
+            if not accepted:
+                # frozen
+                break
+            temperature *= self.cooling
+        solver.search_moves = moves
+        solver._deadline = deadline
+        solver._load_labels(best_labels)
+        solver._swap()
+
+
+LOCAL_SEARCH = {'descent': Descent, 'first': partial(Descent, 'first'),
+                'sample': partial(Descent, 'sample'), 'tabu': TabuSearch, 
+                'annealing': SimulatedAnnealing}
+
+
+class SharedData(object):
+    """Core arrays of a max-p problem in shared memory.
+
+    Worker processes attach to the adjacency (CSR offsets and indices), z
+    and floor_variable without copying or unpickling them, along with the
+    squares of z and the connected components of w, so that they do not
+    derive these again.
+
+    Parameters
+    ----------
+
+    offsets         : array
+                      (n+1) CSR offsets, see adjacency_arrays
+    indices         : array
+                      CSR neighbor positions, see adjacency_arrays
+    z               : array
+                      n*m array of observations on m attributes
+    floor_variable  : array
+                      n*1 vector of observations on variable for the floor
+    components      : array
+                      n*1 connected component of each area, see
+                      connected_components (found here if None)
+
+    """
+    def __init__(self, offsets, indices, z, floor_variable, components=None):
+        z = np.asarray(z, dtype=float)
+        if z.ndim == 1:
+            z = z.reshape((-1, 1))
+        offsets = np.asarray(offsets, dtype=np.int32)
+        indices = np.asarray(indices, dtype=np.int32)
+        if components is None:
+            components = connected_components(offsets, indices)
+        self.n = len(offsets) - 1
+        self._blocks = {}
+        for name, array in [('offsets', offsets),
+                            ('indices', indices),
+                            ('z', z),
+                            ('z2', z * z),
+                            ('floor_variable', np.asarray(floor_variable, 
+                                                          dtype=float).ravel()),
+                            ('components', np.asarray(components, dtype=np.int32))]:
+            raw = sharedctypes.RawArray(ctypes.c_char, max(array.nbytes, 1))
+            view = np.frombuffer(raw, dtype=array.dtype, count=array.size)
+            view[:] = array.ravel()
+            self._blocks[name] = (raw, array.dtype.str, array.shape)
+        # best number of regions found so far, for pruning constructions
+        self.incumbent = sharedctypes.RawValue(ctypes.c_int, 0)
+
+    @classmethod
+    def from_weights(cls, w, z, floor_variable):
+        offsets, indices = adjacency_arrays(w)
+        return cls(offsets, indices, z, floor_variable)
+
+    def attach(self):
+        """Numpy views of the shared arrays, keyed by name."""
+        arrays = {}
+        for name, (raw, dtype, shape) in self._blocks.items():
+            size = int(np.prod(shape))
+            arrays[name] = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+        return arrays
+
+
+def solve_many(w, z, floor, floor_variable, seeds, initial=100, n_jobs=-1,
+               time_budget=None, local_search=None, prune=False, 
+               warm_start=None):
+    """Independent Maxp solves, one per seed, in a process pool.
+
+    Parameters
+    ----------
+
+    w               : W
+                      spatial weights object
+    z               : array
+                      n*m array of observations on m attributes
+    floor           : int
+                      a minimum bound for a variable that has to be
+                      obtained in each region
+    floor_variable  : array
+                      n*1 vector of observations on variable for the floor
+    seeds           : list
+                      one random seed per solve
+    initial         : int
+                      number of initial solutions to generate per solve
+    n_jobs          : int
+                      number of worker processes; -1 uses all CPU cores
+    time_budget     : float
+                      seconds each solve may take, see Maxp
+    local_search    : string or engine
+                      local search for each solve, see Maxp
+    prune           : bool
+                      prune constructions by number of regions, see Maxp
+    warm_start      : dict or array
+                      partition each solve starts from, see Maxp
+
+    Returns
+    -------
+
+    generator of (labels, wss, p, seconds) tuples in the order of seeds,
+    where labels is the int32 region of every area in w.id_order order.
+    The solution for a seed is the same as Maxp(..., seed=seed) gives.
+
+    """
+    shared = SharedData.from_weights(w, z, floor_variable)
+    if isinstance(warm_start, dict):
+        # workers only know positions
+        warm_start = [warm_start.get(area, -1) for area in w.id_order]
+    workers = _workers(n_jobs, len(seeds))
+    results = _pool_imap(workers, shared, floor, [], _solve_seed, 
+                         [(seed, initial, time_budget, local_search, prune, 
+                           warm_start) for seed in seeds])
+    try:
+        for result in results:
+            yield result
+    finally:
+        results.close()
+
+
+def _workers(n_jobs, tasks):
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count()
+    return max(1, min(n_jobs, tasks))
+
+
+def _pool_imap(workers, shared, floor, seed_positions, func, tasks, prune=False):
+    # run func over tasks in worker processes attached to shared, yielding
+    # results in task order
+    pool = multiprocessing.Pool(workers, _init_worker, 
+                                (shared, floor, seed_positions, prune))
+    try:
+        for result in pool.imap(func, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# solver held by each worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(shared, floor, seed_positions, prune):
+    _worker['solver'] = Maxp._attached(shared, floor, seed_positions, prune)
+
+
+def _build_initial(seed):
+    # labels of one construction, and whether it was pruned
+    solver = _worker['solver']
+    pruned = solver.pruned
+    labels = solver._construct(seed)
+    return labels, solver.pruned - pruned
+
+
+def _contiguous_order(task, neighbors=None):
+    seed, cards, maxiter = task
+    if neighbors is None:
+        neighbors = _worker['solver']._neighbors
+    order = random_contiguous_partition(neighbors, cards, random.Random(seed), maxiter)
+    if order is None:
+        return None
+    return np.array(order, dtype=np.int32)
+
+
+def _solve_seed(task):
+    seed, initial, time_budget, local_search, prune, warm_start = task
+    start = time.time()
+    solver = _worker['solver']
+    solver.local_search = local_search
+    solver.prune = prune
+    solver.warm_start = warm_start
+    # solves in other workers must not see this solve's incumbent
+    solver._incumbent = sharedctypes.RawValue(ctypes.c_int, 0)
+    solver._seed_random(seed)
+    solver._solve(initial, time_budget)
+    if not solver.feasible:
+        return None, None, 0, time.time() - start
+    labels = np.array(solver._a2r, dtype=np.int32)
+    return labels, solver.objective_function(), solver.k, time.time() - start
+
+
 class Maxp_LISA(Maxp):
     """Max-p regionalization using LISA seeds
 
@@ -556,6 +2100,8 @@ class Maxp_LISA(Maxp):
     initial        : int
                      number of initial feasible solutions to generate
                      prior to swapping
+    seed           : int
+                     seed for the solver's own random number generators
 
     Attributes
     ----------
@@ -610,13 +2156,13 @@ class Maxp_LISA(Maxp):
     [99, 89, 98]
 
     """
-    def __init__(self, w, z, y, floor, floor_variable, initial=100):
+    def __init__(self, w, z, y, floor, floor_variable, initial=100, seed=None):
 
         lis = pysal.Moran_Local(y, w)
         ids = np.argsort(lis.Is)
         ids = ids[range(w.n - 1, -1, -1)]
-        ids = ids.tolist()
+        ids = [w.id_order[i] for i in ids]
         mp = Maxp.__init__(
             self, w, z, floor=floor, floor_variable=floor_variable,
-            initial=initial, seeds=ids)
+            initial=initial, seeds=ids, seed=seed)
 
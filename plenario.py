@@ -0,0 +1,678 @@
+"""
+Plenario API client
+
+Download Plenario timeseries for many census units concurrently, over
+keep-alive connections, with rate limiting, retries and resumable progress,
+or page through the event-level records of a whole county at once. Counts are
+kept by month in a CountCube, which answers any later time window locally.
+"""
+
+import httplib
+import urllib
+import urlparse
+import socket
+import threading
+import Queue
+import json
+import os
+import random
+import time
+import hashlib
+import tempfile
+import calendar
+from StringIO import StringIO
+import numpy as np
+import pandas as pd
+
+__all__ = ["Downloader", "RateLimiter", "ResponseCache", "CountCube", 
+           "DownloadError", "monthly_counts", "block_counts", "load_cube"]
+
+BASE_URL = 'http://plenar.io/v1/api/timeseries/'
+DETAIL_URL = 'http://plenar.io/v1/api/detail/'
+BLOCK_FIELD = 'census_block'  # census block FIPS of each record in detail responses
+DATE_FIELD = 'point_date'  # date of each record in detail responses
+PERIOD_FIELD = 'temporal_group'  # start of each period in timeseries responses
+PERIODS = ('month', 'quarter', 'year', 'decade')  # aggregations a CountCube gives
+PAGE_SIZE = 10000  # records per detail request
+N_THREADS = 8
+RATE = 10.  # requests per second, over all threads
+RETRIES = 5
+BACKOFF = 0.5  # seconds before the first retry, doubled for each next one
+TIMEOUT = 60
+RETRY_STATUS = (429, 500, 502, 503, 504)
+CACHE_TTL = 30 * 24 * 3600  # seconds a cached response stays valid
+CACHE_SIZE = 2 ** 30  # bytes of cached responses kept on disk
+
+
+class DownloadError(IOError):
+    """A request that failed for good, after any retries."""
+
+
+class RateLimiter(object):
+    """Space out calls from any number of threads to at most rate per second.
+
+    Parameters
+    ----------
+
+    rate        : float
+                  calls per second; None or 0 for no limit
+
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        """Block until the caller may go ahead."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + 1. / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ResponseCache(object):
+    """Responses stored on disk under the sha1 of their normalised query.
+
+    Queries that only differ in the order of their parameters, or of the
+    datasets in dataset_name__in, share an entry. Entries older than ttl are
+    ignored and removed, and once the cache holds more than max_bytes the
+    oldest entries are removed first.
+
+    Parameters
+    ----------
+
+    directory   : string
+                  folder holding the cached responses (created if missing)
+    ttl         : float
+                  seconds a response stays valid (30 days by default; None
+                    to keep responses until they are evicted)
+    max_bytes   : int
+                  size the cache is kept under (1 GB by default)
+
+    """
+    def __init__(self, directory, ttl=CACHE_TTL, max_bytes=CACHE_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, url, query):
+        """sha1 of the normalised form of a query sent to url."""
+        params = []
+        for name, value in urlparse.parse_qsl(query, keep_blank_values=True):
+            if name == 'dataset_name__in':
+                value = ','.join(sorted(set(value.split(','))))
+            params.append((name, value))
+        return hashlib.sha1(url + '?' + urllib.urlencode(sorted(params))).hexdigest()
+
+    def get(self, url, query):
+        """Cached body of the response to query, or None."""
+        path = self._path(self.key(url, query))
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if self.ttl is not None and age > self.ttl:
+                self._remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, url, query, body):
+        """Store the body of the response to query."""
+        path = self._path(self.key(url, query))
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # made by another thread in the meantime
+                pass
+        # write to a temporary file first so readers never see half a body
+        handle, temp = tempfile.mkstemp(dir=folder)
+        with os.fdopen(handle, 'wb') as f:
+            f.write(body)
+        os.rename(temp, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for path, size, mtime in self._entries())
+            else:
+                self._size += len(body)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        # (path, size, mtime) of every cached response
+        for folder, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        # remove the oldest responses until the cache is a tenth under size
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            self._remove(path)
+            self._size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Downloader(object):
+    """Fetch Plenario API responses with a bounded pool of threads.
+
+    Each thread keeps its own keep-alive connection to the server. Requests
+    are rate limited over all threads, and connection errors or busy server
+    responses (429 and 5xx) are retried with exponential backoff.
+
+    Parameters
+    ----------
+
+    base_url    : string
+                  endpoint that queries are sent to; point it at a local
+                    server to test without Plenario
+    n_threads   : int
+                  number of requests in flight at once
+    rate        : float
+                  maximum requests per second (None for no limit)
+    retries     : int
+                  number of times a failed request is tried again
+    backoff     : float
+                  seconds to wait before the first retry, doubled for each
+                    next one (with random jitter)
+    timeout     : float
+                  seconds to wait for the server on each request
+    cache       : ResponseCache
+                  responses are looked up here before being requested, and
+                    stored here once they arrive (None for no cache)
+
+    Sample usage
+    ------------
+
+    >>> dl = Downloader(n_threads=4)
+    >>> params = [('dataset_name__in', 'crimes_2001_to_present'),
+          ('census_block', '170310101001000')]
+    >>> body = dl.get(params)
+
+    """
+    def __init__(self, base_url=BASE_URL, n_threads=N_THREADS, rate=RATE,
+        retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT, cache=None):
+        parts = urlparse.urlsplit(base_url)
+        self.base_url = base_url
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.path = parts.path or '/'
+        self.n_threads = n_threads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.cache = cache
+
+    def query(self, params):
+        """Query string for a list of (name, value) parameters."""
+        return urllib.urlencode(params)
+
+    def get(self, params, connection=None):
+        """Body of the response to one query, retrying as needed.
+
+        Parameters
+        ----------
+
+        params      : list
+                      (name, value) query parameters
+        connection  : httplib.HTTPConnection
+                      connection to reuse; a new one is opened if None
+
+        """
+        own = connection is None
+        if own:
+            connection = self._connect()
+        try:
+            return self._body(self.query(params), connection)
+        finally:
+            if own:
+                connection.close()
+
+    def fetch(self, queries, parse=None, journal=None):
+        """Fetch many queries concurrently.
+
+        Parameters
+        ----------
+
+        queries     : list
+                      (key, params) pairs, where params is a list of (name,
+                        value) query parameters
+        parse       : function
+                      applied to each response body in the worker threads;
+                        its result must be JSON serialisable if a journal is
+                        kept (None keeps the body)
+        journal     : string
+                      file recording each parsed result as it arrives. if the
+                        download stops, running it again with the same
+                        journal only fetches the queries still missing. the
+                        file is removed once every result has been returned
+
+        Returns
+        -------
+
+        generator of (key, result) pairs, in the order they complete (those
+        already in the journal first)
+
+        """
+        for key, result in self._fetch(queries, parse, journal):
+            yield key, result
+        self._clear_journal(journal)
+
+    def _fetch(self, queries, parse, journal):
+        # fetch, leaving the journal in place
+        done = self._read_journal(journal)
+        keys = {}
+        pending = Queue.Queue()
+        for key, params in queries:
+            query = self.query(params)
+            if query in done:
+                continue
+            if query not in keys:
+                keys[query] = []
+                pending.put(query)
+            keys[query].append(key)
+        for key, params in queries:
+            query = self.query(params)
+            if query in done:
+                yield key, done[query]
+        if not keys:
+            return
+        results = Queue.Queue()
+        stop = threading.Event()
+        threads = []
+        for i in range(min(self.n_threads, len(keys))):
+            thread = threading.Thread(target=self._work,
+                                      args=(pending, results, parse, stop))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        out = open(journal, 'a') if journal else None
+        try:
+            for i in range(len(keys)):
+                query, result, error = results.get()
+                if error is not None:
+                    raise error
+                if out:
+                    out.write(json.dumps([query, result]) + '\n')
+                    out.flush()
+                for key in keys[query]:
+                    yield key, result
+        finally:
+            stop.set()
+            if out:
+                out.close()
+
+    def fetch_pages(self, params, parse, page_size=PAGE_SIZE, journal=None):
+        """Fetch every page of a paged query, n_threads pages at a time.
+
+        Pages are requested with limit and offset parameters until one comes
+        back with fewer than page_size records.
+
+        Parameters
+        ----------
+
+        params      : list
+                      (name, value) query parameters, without limit or offset
+        parse       : function
+                      applied to each page body; must return a pair of the
+                        number of records in the page and the parsed result
+        page_size   : int
+                      records asked for in each request
+        journal     : string
+                      file recording each page as it arrives, removed once
+                        the last page has been returned (see fetch)
+
+        Returns
+        -------
+
+        generator of (n_records, result) pairs, in page order
+
+        """
+        offset = 0
+        while True:
+            offsets = range(offset, offset + self.n_threads * page_size, page_size)
+            queries = [(o, params + [('limit', page_size), ('offset', o)]) 
+                for o in offsets]
+            pages = dict(self._fetch(queries, parse, journal))
+            for o in offsets:
+                n_records, result = pages[o]
+                yield n_records, result
+                if n_records < page_size:
+                    self._clear_journal(journal)
+                    return
+            offset = offsets[-1] + page_size
+
+    def _work(self, pending, results, parse, stop):
+        # worker thread: take queries until there are none left
+        connection = self._connect()
+        try:
+            while not stop.is_set():
+                try:
+                    query = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    body = self._body(query, connection)
+                    if parse is not None:
+                        body = parse(body)
+                    results.put((query, body, None))
+                except Exception as e:
+                    results.put((query, None, e))
+        finally:
+            connection.close()
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _body(self, query, connection):
+        # body of the response to a query string, from the cache if it can
+        if self.cache is not None:
+            body = self.cache.get(self.base_url, query)
+            if body is not None:
+                return body
+        body = self._get(self.path + '?' + query, connection)
+        if self.cache is not None:
+            self.cache.put(self.base_url, query, body)
+        return body
+
+    def _get(self, url, connection):
+        # one request with retries; reconnects the connection after errors
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            delay = None
+            try:
+                connection.request('GET', url, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                body = response.read()
+                if response.status == 200:
+                    return body
+                error = DownloadError('HTTP ' + str(response.status) + ' for ' + url)
+                if response.status not in RETRY_STATUS:
+                    raise error
+                retry_after = response.getheader('retry-after')
+                if retry_after and retry_after.isdigit():
+                    delay = float(retry_after)
+            except (socket.error, httplib.HTTPException) as e:
+                error = DownloadError(str(e) + ' for ' + url)
+                connection.close()
+            if attempt < self.retries:
+                if delay is None:
+                    delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                time.sleep(delay)
+        raise error
+
+    def _clear_journal(self, journal):
+        # a finished download needs no journal; later runs go to the cache
+        if journal and os.path.exists(journal):
+            os.remove(journal)
+
+    def _read_journal(self, journal):
+        # results recorded by an earlier run, by query string
+        done = {}
+        if journal and os.path.exists(journal):
+            with open(journal) as f:
+                for line in f:
+                    try:
+                        query, result = json.loads(line)
+                    except ValueError:
+                        # a line cut short when the last run stopped
+                        continue
+                    done[query] = result
+        return done
+
+
+def monthly_counts(body, datasets):
+    """Count of each dataset by month in a timeseries CSV response.
+
+    The response must be aggregated by month. Datasets missing from the
+    response count 0, and months where every dataset counts 0 are left out.
+
+    Parameters
+    ----------
+
+    body        : string
+                  CSV text returned by the timeseries endpoint
+    datasets    : list
+                  machine names of the datasets
+
+    Returns
+    -------
+
+    dict with the months ('yyyy-mm') under 'months' and, under 'counts', a
+    list holding the count of each dataset for each of them
+
+    """
+    try:
+        cr = pd.read_csv(StringIO(body), dtype=object)
+        months = cr[PERIOD_FIELD].str[:7]
+    except Exception:
+        return {'months': [], 'counts': []}
+    counts = np.zeros((len(cr), len(datasets)), dtype=int)
+    for j, name in enumerate(datasets):
+        if name in cr:
+            counts[:, j] = pd.to_numeric(cr[name], errors='coerce').fillna(0)
+    keep = counts.any(axis=1)
+    return {'months': list(months[keep]), 'counts': counts[keep].tolist()}
+
+
+def block_counts(body, field=BLOCK_FIELD, date_field=DATE_FIELD):
+    """Number of records by census block and month in a detail CSV response.
+
+    Parameters
+    ----------
+
+    body        : string
+                  CSV text returned by the detail endpoint, one record per row
+    field       : string
+                  column holding the census block FIPS of each record
+    date_field  : string
+                  column holding the date ('yyyy-mm-dd...') of each record
+
+    Returns
+    -------
+
+    pair of the number of records and a dict of equal length lists 'blocks',
+    'months' ('yyyy-mm') and 'counts'
+
+    """
+    try:
+        cr = pd.read_csv(StringIO(body), dtype=object)
+    except Exception:
+        return 0, {'blocks': [], 'months': [], 'counts': []}
+    records = cr[[field, date_field]].dropna()
+    counts = records.groupby([records[field], records[date_field].str[:7]]).size()
+    return len(cr), {'blocks': list(counts.index.get_level_values(0)), 
+                     'months': list(counts.index.get_level_values(1)),
+                     'counts': [int(n) for n in counts]}
+
+
+class CountCube(object):
+    """Counts of records by census unit, dataset and month.
+
+    Any time window or temporal aggregation within the months the counts were
+    downloaded for is answered from the cube, without going back to Plenario.
+    Windows are rounded out to whole months, so only windows that start on
+    the first of a month and end on the last of one (or at the cube's own
+    first and last days) match a download over the same dates; see covers.
+
+    Parameters
+    ----------
+
+    units       : array
+                  IDs of the census units
+    datasets    : list
+                  machine names of the datasets
+    months      : array
+                  months ('yyyy-mm') in increasing order
+    counts      : array
+                  n_units x n_datasets x n_months counts
+    time_start  : 'yyyy-mm-dd'
+                  first day the counts were downloaded for
+    time_end    : 'yyyy-mm-dd'
+                  last day the counts were downloaded for
+
+    Sample usage
+    ------------
+
+    >>> cube = load_cube('plenario counts.npz')
+    >>> totals = cube.totals('2014-01-01', '2014-12-31')
+    >>> periods, counts = cube.aggregate('quarter')
+
+    """
+    def __init__(self, units, datasets, months, counts, time_start, time_end):
+        self.units = np.asarray(units, dtype=str)
+        self.datasets = list(datasets)
+        self.months = np.asarray(months, dtype=str)
+        self.counts = np.asarray(counts, dtype=np.int32)
+        self.time_start = time_start
+        self.time_end = time_end
+
+    def covers(self, units, datasets, time_start, time_end):
+        """Whether the cube holds the exact counts for these units, datasets 
+        and dates.
+
+        The window must lie within the cube's dates, and each of its ends
+        must either fall on a month boundary or match the cube's own end.
+
+        """
+        year, month = int(time_end[:4]), int(time_end[5:7])
+        month_end = '%s-%02d' % (time_end[:7], calendar.monthrange(year, month)[1])
+        return (self.time_start <= time_start and time_end <= self.time_end and 
+            (time_start == self.time_start or time_start[8:10] == '01') and
+            (time_end == self.time_end or time_end[:10] == month_end) and
+            set(datasets) <= set(self.datasets) and 
+            (pd.Index(self.units).get_indexer(units) >= 0).all())
+
+    def totals(self, time_start=None, time_end=None, units=None, datasets=None):
+        """Total count of each dataset for each unit over a time window.
+
+        Parameters
+        ----------
+
+        time_start  : 'yyyy-mm-dd'
+                      first day of the window (the cube's first by default)
+        time_end    : 'yyyy-mm-dd'
+                      last day of the window (the cube's last by default)
+        units       : array
+                      units to return, in this order (all by default)
+        datasets    : list
+                      datasets to return, in this order (all by default)
+
+        Returns
+        -------
+
+        n_units x n_datasets array
+
+        """
+        first, last = self._span(time_start, time_end)
+        counts = self._select(units, datasets)
+        return counts[:, :, first:last].sum(axis=2)
+
+    def aggregate(self, temporal_agg='month', time_start=None, time_end=None, 
+        units=None, datasets=None):
+        """Counts by period.
+
+        Parameters
+        ----------
+
+        temporal_agg: {'month', 'quarter', 'year', 'decade'}
+                      length of the periods
+        time_start  : 'yyyy-mm-dd'
+                      first day of the window (the cube's first by default)
+        time_end    : 'yyyy-mm-dd'
+                      last day of the window (the cube's last by default)
+        units       : array
+                      units to return, in this order (all by default)
+        datasets    : list
+                      datasets to return, in this order (all by default)
+
+        Returns
+        -------
+
+        pair of the period labels and an n_units x n_datasets x n_periods 
+        array of counts
+
+        """
+        first, last = self._span(time_start, time_end)
+        months = self.months[first:last]
+        years = np.array([month[:4] for month in months], dtype=str)
+        if temporal_agg == 'month':
+            labels = months
+        elif temporal_agg == 'quarter':
+            labels = np.array([month[:4] + '-Q' + str((int(month[5:7]) + 2) // 3) 
+                for month in months], dtype=str)
+        elif temporal_agg == 'year':
+            labels = years
+        elif temporal_agg == 'decade':
+            labels = np.array([year[:3] + '0' for year in years], dtype=str)
+        else:
+            raise ValueError("temporal_agg must be in {'month', 'quarter', "
+                "'year', 'decade'}")
+        periods, period = np.unique(labels, return_inverse=True)
+        counts = self._select(units, datasets)[:, :, first:last]
+        out = np.zeros(counts.shape[:2] + (len(periods),), dtype=counts.dtype)
+        for k in range(len(periods)):
+            out[:, :, k] = counts[:, :, period == k].sum(axis=2)
+        return periods, out
+
+    def save(self, path):
+        """Write the cube to a compressed .npz file."""
+        np.savez_compressed(path, units=self.units, 
+            datasets=np.asarray(self.datasets, dtype=str), months=self.months, 
+            counts=self.counts, window=np.array([self.time_start, self.time_end]))
+
+    def _span(self, time_start, time_end):
+        # first and last+1 positions of the months in a window
+        first = np.searchsorted(self.months, (time_start or self.time_start)[:7])
+        last = np.searchsorted(self.months, (time_end or self.time_end)[:7], 
+            side='right')
+        return first, last
+
+    def _select(self, units, datasets):
+        # counts for the given units and datasets, in their order
+        counts = self.counts
+        if units is not None:
+            counts = counts[pd.Index(self.units).get_indexer(units)]
+        if datasets is not None:
+            counts = counts[:, [self.datasets.index(name) for name in datasets]]
+        return counts
+
+
+def load_cube(path):
+    """Read a CountCube written by CountCube.save."""
+    f = np.load(path)
+    try:
+        return CountCube(f['units'], list(f['datasets']), f['months'], 
+            f['counts'], *list(f['window']))
+    finally:
+        f.close()
@@ -0,0 +1,155 @@
+### script to test the Plenario downloader against a local stand-in server
+### run with: python test_plenario.py
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import os
+import tempfile
+import threading
+import urlparse
+
+import plenario
+
+DATASETS = ['crimes_2001_to_present', '311_service_requests_rodent_baiting']
+MONTHS = ['2015-01-01', '2015-02-01', '2015-03-01']
+
+
+def count(block, dataset, month):
+    """Count the stand-in server gives a block, dataset and month."""
+    return int(hashlib.md5(block + dataset + month).hexdigest()[:6], 16) % 5
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer timeseries queries with made-up monthly counts.
+
+    The first `failures` requests for each query get a 503, so that every
+    query only goes through after being retried.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the downloader expects
+
+    def do_GET(self):
+        server = self.server
+        query = urlparse.urlsplit(self.path).query
+        with server.lock:
+            server.requests += 1
+            tries = server.tries[query] = server.tries.get(query, 0) + 1
+        if tries <= server.failures:
+            with server.lock:
+                server.busy += 1
+            self._send(503, 'busy')
+            return
+        params = urlparse.parse_qs(query)
+        datasets = params['dataset_name__in'][0].split(',')
+        block = params['census_block'][0]
+        lines = [plenario.PERIOD_FIELD + ',' + ','.join(datasets)]
+        for month in MONTHS:
+            lines.append(month + ',' +
+                ','.join(str(count(block, d, month)) for d in datasets))
+        self._send(200, '\n'.join(lines) + '\n')
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded stand-in for the Plenario timeseries endpoint.
+
+    Parameters
+    ----------
+
+    failures    : int
+                  number of 503 responses sent for each query before it is
+                    answered
+
+    Attributes
+    ----------
+
+    url         : string
+                  endpoint to give Downloader (or Blobs_Data as api_url)
+    requests    : int
+                  number of requests received
+    busy        : int
+                  number of 503 responses sent
+
+    """
+    daemon_threads = True
+
+    def __init__(self, failures=1):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.tries = {}
+        self.requests = 0
+        self.busy = 0
+        self.url = 'http://127.0.0.1:%d/v1/api/timeseries/' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def queries(n):
+    """n (block, params) pairs for made-up census blocks."""
+    blocks = [str(170310101001000 + i) for i in range(n)]
+    return [(block, [('dataset_name__in', ','.join(DATASETS)),
+        ('census_block', block)]) for block in blocks]
+
+
+def parse(body):
+    return plenario.monthly_counts(body, DATASETS)
+
+
+def expected(block):
+    counts = [[count(block, d, month) for d in DATASETS] for month in MONTHS]
+    keep = [any(row) for row in counts]
+    return {'months': [m[:7] for m, k in zip(MONTHS, keep) if k],
+            'counts': [row for row, k in zip(counts, keep) if k]}
+
+
+def test_retries():
+    # every query is answered with a 503 twice before it goes through
+    server = StandInServer(failures=2)
+    dl = plenario.Downloader(server.url, n_threads=4, rate=None, backoff=0.01)
+    results = dict(dl.fetch(queries(40), parse))
+    assert len(results) == 40
+    for block, result in results.items():
+        assert result == expected(block)
+    assert server.busy == 80
+    assert server.requests == 120
+    server.shutdown()
+
+
+def test_resume():
+    # a download stopped part way only asks for what is missing when rerun
+    server = StandInServer(failures=1)
+    dl = plenario.Downloader(server.url, n_threads=4, rate=None, backoff=0.01)
+    journal = os.path.join(tempfile.mkdtemp(), 'progress.jsonl')
+    downloads = dl.fetch(queries(40), parse, journal)
+    first = dict(next(downloads) for i in range(15))
+    downloads.close()
+    assert os.path.exists(journal)
+    tries = dict((query, server.tries[query]) for query in
+        [dl.query(params) for block, params in queries(40) if block in first])
+    results = dict(dl.fetch(queries(40), parse, journal))
+    assert len(results) == 40
+    for block, result in results.items():
+        assert result == expected(block)
+    for block in first:
+        assert results[block] == first[block]
+    # queries done before the stop are not asked for again
+    for query in tries:
+        assert server.tries[query] == tries[query]
+    assert not os.path.exists(journal)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    test_retries()
+    test_resume()
+    print 'ok'